@@ -18,10 +18,30 @@
 
 from __future__ import print_function
 from datetime import datetime
+import ctypes
+import time
 
 from pcp import pmapi
 import cpmapi as c_api
 
+# C type of the values of each numeric PCP type
+VALUE_CTYPES = {
+    c_api.PM_TYPE_32: ctypes.c_int32,
+    c_api.PM_TYPE_U32: ctypes.c_uint32,
+    c_api.PM_TYPE_64: ctypes.c_int64,
+    c_api.PM_TYPE_U64: ctypes.c_uint64,
+    c_api.PM_TYPE_FLOAT: ctypes.c_float,
+    c_api.PM_TYPE_DOUBLE: ctypes.c_double,
+}
+# Values in pmValueBlocks are gathered with a single copy of the memory
+# holding them when the blocks are packed (as in a decoded archive
+# record), i.e. they span less than this many bytes per value
+BULK_MAX_SPAN = 32
+
+# Instance key of the values of metrics without an instance domain,
+# which are stored under the 0 indom
+SINGLE_VALUE = -1
+
 class PcpHelp(object):
     '''Help texts are not shipped in an archive file. This class is used
     to fetch the help texts from the locally running pmcd service. This
@@ -51,17 +71,35 @@ class PcpHelp(object):
             except:
                 pass
 
+class PcpMetric(object):
+    '''Compact descriptor of a single metric contained in an archive'''
+    __slots__ = ('pmid', 'name', 'type', 'sem', 'units', 'indom', 'desc')
+
+    def __init__(self, pmid, name, desc):
+        self.pmid = pmid
+        self.name = name
+        self.type = desc.contents.type
+        self.sem = desc.contents.sem
+        self.units = desc.contents.units
+        self.indom = desc.contents.indom
+        # The pmDesc pointer itself is needed by the instance domain calls
+        self.desc = desc
+
 class PcpArchive(object):
     '''Class to make it easy to extract data from a PCP archive'''
     pcparchive = ''
     context = None
     result = None
-    # keys is the metric string. Value is (type, sem, units)
-    pmns = {}
 
     def __init__(self, pcp_fname, start=None, end=None):
         '''Opens a PCP archive and does an initial walk of the PMNS tree'''
         self.pcparchive = pcp_fname
+        # Metric names found in the PMNS walk. The descriptors are only
+        # looked up in bulk once they are needed (see _load_metadata)
+        self._names = []
+        # keys are the metric strings and the PMIDs. Values are PcpMetric
+        self.pmns = None
+        self.pmids = None
         self.context = pmapi.pmContext(c_api.PM_CONTEXT_ARCHIVE, pcp_fname)
         self.context.pmTraversePMNS('', self._pmns_callback)
         self.start = start
@@ -77,37 +115,118 @@ class PcpArchive(object):
         secs = tstamp.tv_sec + (tstamp.tv_usec * 10**-6)
         return datetime.fromtimestamp(secs)
 
+    def _datetime_to_timeval(self, dtime):
+        '''Convert a datetime object in a timeval object (tv_sec + tv_usec)'''
+        secs = int(time.mktime(dtime.timetuple()))
+        return pmapi.timeval(secs, dtime.microsecond)
+
     def _pmns_callback(self, label):
         '''Callback for the PMNS tree walk'''
-        pmid = self.context.pmLookupName(label)
-        desc = self.context.pmLookupDesc(pmid[0])
-        self.pmns[label] = (desc.type, desc.sem, desc.contents.units)
-
-    def _extract_value(self, result, desc, i, inst=0):
-        '''Return python value given a pmExtractValue set of parameters'''
-        mtype = desc.contents.type
-        value = self.context.pmExtractValue(
-            result.contents.get_valfmt(i),
-            result.contents.get_vlist(i, inst),
-            mtype, mtype)
-
-        if mtype == c_api.PM_TYPE_U64:
-            retval = value.ull
-        elif mtype == c_api.PM_TYPE_U32:
-            retval = value.ul
-        elif mtype == c_api.PM_TYPE_64:
-            retval = value.ll
-        elif mtype == c_api.PM_TYPE_32:
-            retval = value.l
-        elif mtype == c_api.PM_TYPE_STRING:
-            retval = value.cp
-        elif mtype == c_api.PM_TYPE_FLOAT:
-            retval = value.f
-        elif mtype == c_api.PM_TYPE_DOUBLE:
-            retval = value.d
+        self._names.append(label)
+
+    def _load_metadata(self):
+        '''Looks up the PMIDs of all the metrics with a single call and then
+        their descriptors, filling the self.pmns and self.pmids tables'''
+        if self.pmns is not None:
+            return
+        self.pmns = {}
+        self.pmids = {}
+        if len(self._names) == 0:
+            return
+        pmids = self.context.pmLookupName(self._names)
+        names = [name for (name, pmid) in zip(self._names, pmids)
+                 if pmid != c_api.PM_ID_NULL]
+        pmids = [pmid for pmid in pmids if pmid != c_api.PM_ID_NULL]
+        # Older bindings lack pmLookupDescs
+        if hasattr(self.context, 'pmLookupDescs'):
+            descs = self.context.pmLookupDescs(pmids)
+        else:
+            descs = [self.context.pmLookupDesc(pmid) for pmid in pmids]
+        for (name, pmid, desc) in zip(names, pmids, descs):
+            metric = PcpMetric(pmid, name, desc)
+            self.pmns[name] = metric
+            self.pmids[pmid] = metric
+
+    def _get_metric_by_pmid(self, pmid):
+        '''Returns the PcpMetric of a PMID. PMIDs not seen in the PMNS walk
+        are looked up and added to the tables'''
+        self._load_metadata()
+        if pmid not in self.pmids:
+            metric = PcpMetric(pmid, self.context.pmNameID(pmid),
+                               self.context.pmLookupDesc(pmid))
+            self.pmns[metric.name] = metric
+            self.pmids[pmid] = metric
+        return self.pmids[pmid]
+
+    def _read_string(self, address):
+        '''Returns the string held by the pmValueBlock at address'''
+        block = pmapi.pmValueBlock.from_address(address)
+        header = pmapi.pmValueBlock.vbuf.offset
+        return ctypes.string_at(address + header, block.vlen - header).split('\0', 1)[0]
+
+    def _extract_values(self, vset, mtype):
+        '''Returns a tuple (insts, values) of numpy arrays with all the
+        values of a pmValueSet. They are read directly out of the pmResult
+        instead of with one pmExtractValue call per value. insts are int64
+        and values have the C type of mtype (object for strings). Raises
+        ValueError when the values cannot be converted'''
+        import numpy
+        numval = vset.numval
+        insitu = vset.valfmt == c_api.PM_VAL_INSITU
+        if mtype != c_api.PM_TYPE_STRING and mtype not in VALUE_CTYPES:
+            raise ValueError('Metric has unknown type: [%s]' % mtype)
+        if insitu and (mtype == c_api.PM_TYPE_STRING or
+                       ctypes.sizeof(VALUE_CTYPES[mtype]) != 4):
+            # Only 32 bit values fit in the pmValue itself
+            raise ValueError('Invalid in situ value of type [%s]' % mtype)
+        vlist = ctypes.addressof(vset) + pmapi.pmValueSet.vlist.offset
+        size = ctypes.sizeof(pmapi.pmValue)
+        offset = pmapi.pmValue.value.offset
+        header = pmapi.pmValueBlock.vbuf.offset
+
+        if numval == 1:
+            value = pmapi.pmValue.from_address(vlist)
+            insts = numpy.array([value.inst], dtype=numpy.int64)
+            if insitu:
+                address = vlist + offset
+            else:
+                address = ctypes.cast(value.value.pval, ctypes.c_void_p).value
+                if mtype == c_api.PM_TYPE_STRING:
+                    values = numpy.empty(1, dtype=object)
+                    values[0] = self._read_string(address)
+                    return (insts, values)
+                address += header
+            return (insts, numpy.array([VALUE_CTYPES[mtype].from_address(address).value],
+                                       dtype=VALUE_CTYPES[mtype]))
+
+        dtype = numpy.dtype({'names': ['inst', 'lval', 'pval'],
+                             'formats': ['i4', 'i4', numpy.uintp],
+                             'offsets': [pmapi.pmValue.inst.offset, offset, offset],
+                             'itemsize': size})
+        raw = numpy.frombuffer(ctypes.string_at(vlist, numval * size), dtype=dtype)
+        insts = raw['inst'].astype(numpy.int64)
+        if mtype == c_api.PM_TYPE_STRING:
+            values = numpy.empty(numval, dtype=object)
+            values[:] = [self._read_string(int(address)) for address in raw['pval']]
+            return (insts, values)
+        vtype = numpy.dtype(VALUE_CTYPES[mtype])
+        if insitu:
+            # Copied so that the values do not keep the whole pmValue
+            # buffer alive
+            return (insts, raw['lval'].view(vtype).copy())
+
+        addresses = raw['pval'] + header
+        base = int(addresses.min())
+        span = int(addresses.max()) - base + vtype.itemsize
+        if span <= numval * BULK_MAX_SPAN:
+            memory = numpy.frombuffer(ctypes.string_at(base, span), dtype=numpy.uint8)
+            index = (addresses - base).astype(numpy.intp)[:, None] + numpy.arange(vtype.itemsize)
+            values = memory[index].view(vtype).ravel()
         else:
-            raise Exception("Metric has unknown type: [%s]" % (mtype))
-        return retval
+            # Blocks allocated one by one, copy them separately
+            values = numpy.frombuffer(''.join([ctypes.string_at(int(address), vtype.itemsize)
+                                               for address in addresses]), dtype=vtype)
+        return (insts, values)
 
     def close(self):
         if self.context and self.result:
@@ -120,11 +239,13 @@ class PcpArchive(object):
     def get_metrics(self):
         '''Returns a list of metric labels of all the metrics contained in
         the archive'''
-        return self.pmns.keys()
+        return list(self._names)
 
     def get_metric_info(self, metric):
         '''Given a metric label, return (type, sem, units)'''
-        return self.pmns[metric]
+        self._load_metadata()
+        info = self.pmns[metric]
+        return (info.type, info.sem, info.units)
 
     def get_pmids(self, metrics):
         '''Given a list of metrics, returns a list of PMIDs'''
@@ -138,9 +259,55 @@ class PcpArchive(object):
         d2 = self._timestamp_to_datetime(self.end_time)
         return (d1, d2)
 
-    def get_values(self, progress=None):
+    def _get_instances(self, metrics):
+        '''Returns a tuple (instances, ambiguous) for the instance domains of
+        the given PcpMetric objects. instances maps an indom to a dictionary
+        {inst: name} and is filled with a single pmGetInDomArchive call per
+        indom. That call returns every instance that ever appeared in the
+        archive, so instances coming and going over time (processes,
+        containers) are all covered. ambiguous maps an indom to the set of
+        inst ids that were reused with different names over time. Those
+        need to be resolved at the current archive position'''
+        instances = {}
+        ambiguous = {}
+        for metric in metrics:
+            if metric.indom == c_api.PM_INDOM_NULL or metric.indom in instances:
+                continue
+            names = {}
+            reused = set()
+            try:
+                (insts, inames) = self.context.pmGetInDomArchive(metric.desc)
+            except pmapi.pmErr:
+                insts = inames = []
+            for (inst, name) in zip(insts, inames):
+                if inst in names and names[inst] != name:
+                    reused.add(inst)
+                names[inst] = name
+            for inst in reused:
+                del names[inst]
+            instances[metric.indom] = names
+            ambiguous[metric.indom] = reused
+        return (instances, ambiguous)
+
+    def _instance_name(self, metric, inst, instances, ambiguous):
+        '''Returns the name of an instance that was not found in the
+        prefetched instance names'''
+        if inst in ambiguous.get(metric.indom, ()):
+            # pmNameInDom honours the current position in the archive
+            return self.context.pmNameInDom(metric.desc, inst)
+        name = self.context.pmNameInDomArchive(metric.desc, inst)
+        instances.setdefault(metric.indom, {})[inst] = name
+        return name
+
+    def get_pmid_set(self, metrics):
+        '''Given a list of metric labels, returns the set of their PMIDs'''
+        self._load_metadata()
+        return set([self.pmns[metric].pmid for metric in metrics if metric in self.pmns])
+
+    def get_values(self, progress=None, metrics=None):
         '''Returns a dictionary of dictionary containing all the data within
-        a PCP archive log file. Data will be returned as a a tuple
+        a PCP archive log file. If metrics is given only the values of those
+        metrics are extracted. Data will be returned as a a tuple
         (data, skipped_metrics). skipped_metrics is a list of metrics skipped
         because the archive log was corrupted. data will be in the following
         form:
@@ -155,11 +322,34 @@ class PcpArchive(object):
         the actual values. If a metric has no indom 0 will be used as its key'''
 
         data = {}
-        self.context.pmSetMode(c_api.PM_MODE_FORW, self.start_time, 0)
+        # Position the archive directly at the requested start. libpcp uses
+        # the temporal index of the archive to seek there, so the records
+        # before the start are never read
+        origin = self.start_time
+        if self.start:
+            origin = self._datetime_to_timeval(self.start)
+        self.context.pmSetMode(c_api.PM_MODE_FORW, origin, 0)
         skipped_metrics = []
-        # This is just used as an optimization. The keys are (numpmid, numinst) and the value is
-        # the indom name. This avoids too many expensive calls to pmNameInDomArchive
-        indom_map = {}
+        # Resolve all the instance names upfront. This avoids one expensive
+        # pmNameInDomArchive call per instance within the fetch loop
+        self._load_metadata()
+        selected = None
+        if metrics is not None:
+            selected = self.get_pmid_set(metrics)
+            (instances, ambiguous) = self._get_instances([self.pmids[pmid]
+                                                          for pmid in selected])
+        else:
+            (instances, ambiguous) = self._get_instances(self.pmns.values())
+        # Timestamps of the records read
+        stamps = []
+        # pmid -> (records, counts, keys, values). records and counts are
+        # lists with the index of every record the metric has values in and
+        # how many. keys and values are lists of numpy arrays, one per such
+        # record. keys are instance ids, SINGLE_VALUE or the code of a
+        # reused instance
+        columns = {}
+        # Reused instance name -> code, below SINGLE_VALUE
+        reused_codes = {}
         while 1:
             try:
                 result = self.context.pmFetchArchive()
@@ -172,8 +362,11 @@ class PcpArchive(object):
                     raise error
 
             ts = self._timestamp_to_datetime(result.contents.timestamp)
-            if ((self.start and ts < self.start) or
-                (self.end and ts > self.end)):
+            # Records are in time order so nothing after the end can be used
+            if self.end and ts > self.end:
+                self.context.pmFreeResult(result)
+                break
+            if self.start and ts < self.start:
                 self.context.pmFreeResult(result)
                 if progress:
                     progress(False)
@@ -181,47 +374,72 @@ class PcpArchive(object):
 
             if progress:
                 progress(True)
+            record = len(stamps)
+            stamps.append(ts)
             for i in range(result.contents.numpmid):
-                pmid = result.contents.get_pmid(i)
-                desc = self.context.pmLookupDesc(pmid)
-                metric = self.context.pmNameID(pmid)
-                if metric not in data:
-                    data[metric] = {}
-                count = result.contents.get_numval(i)
-                if count <= 1: # No indoms are present
-                    try:
-                        value = self._extract_value(result, desc, i)
-                    except pmapi.pmErr, error:
-                        if error.args[0] in [c_api.PM_ERR_CONV]:
-                            skipped_metrics.append(metric)
-                            continue
-                        raise error
-                    if 0 not in data[metric]:
-                        data[metric][0] = [[ts,], [value,]]
-                    else:
-                        data[metric][0][0].append(ts)
-                        data[metric][0][1].append(value)
+                vset = result.contents.get_vset(i).contents
+                pmid = vset.pmid
+                if selected is not None and pmid not in selected:
                     continue
-
-                for j in range(count):
-                    inst = result.contents.get_inst(i, j)
-                    try:
-                        value = self._extract_value(result, desc, i, j)
-                    except pmapi.pmErr, error:
-                        if error.args[0] in [c_api.PM_ERR_CONV]:
-                            skipped_metrics.append(metric)
-                            continue
-                    if (i, j) not in indom_map:
-                        indom = self.context.pmNameInDomArchive(desc, inst)
-                        indom_map[(i, j)] = indom
-                    else:
-                        indom = indom_map[(i, j)]
-                    if indom not in data[metric]:
-                        data[metric][indom] = [[ts,], [value,]]
-                    else:
-                        data[metric][indom][0].append(ts)
-                        data[metric][indom][1].append(value)
+                info = self._get_metric_by_pmid(pmid)
+                if info.name not in data:
+                    data[info.name] = {}
+                if vset.numval <= 0:
+                    # A negative numval is the error fetching the metric
+                    if vset.numval < 0 and info.name not in skipped_metrics:
+                        skipped_metrics.append(info.name)
+                    continue
+                try:
+                    (insts, values) = self._extract_values(vset, info.type)
+                except ValueError:
+                    if info.name not in skipped_metrics:
+                        skipped_metrics.append(info.name)
+                    continue
+                if info.indom == c_api.PM_INDOM_NULL: # No indoms are present
+                    insts[:] = SINGLE_VALUE
+                elif info.indom in ambiguous and len(ambiguous[info.indom]) > 0:
+                    # Reused instances are only named correctly now
+                    reused = ambiguous[info.indom]
+                    for (j, inst) in enumerate(insts.tolist()):
+                        if inst in reused:
+                            name = self.context.pmNameInDom(info.desc, inst)
+                            insts[j] = reused_codes.setdefault(name, SINGLE_VALUE - 1 -
+                                                               len(reused_codes))
+                if pmid not in columns:
+                    columns[pmid] = ([], [], [], [])
+                (records, counts, keys, vals) = columns[pmid]
+                records.append(record)
+                counts.append(len(insts))
+                keys.append(insts)
+                vals.append(values)
 
             self.context.pmFreeResult(result)
 
+        # Split the values of every metric by instance, keeping them in
+        # record order
+        import numpy
+        stamps = numpy.array(stamps, dtype=object)
+        reused_names = dict([(code, name) for (name, code) in reused_codes.items()])
+        for (pmid, (records, counts, keys, vals)) in columns.items():
+            info = self.pmids[pmid]
+            keys = numpy.concatenate(keys)
+            order = numpy.argsort(keys, kind='mergesort')
+            keys = keys[order]
+            records = numpy.repeat(records, counts)[order]
+            vals = numpy.concatenate(vals)[order]
+            bounds = (numpy.flatnonzero(numpy.diff(keys)) + 1).tolist()
+            for (first, last) in zip([0] + bounds, bounds + [len(keys)]):
+                key = int(keys[first])
+                if key == SINGLE_VALUE:
+                    indom = 0
+                elif key in reused_names:
+                    indom = reused_names[key]
+                else:
+                    try:
+                        indom = instances[info.indom][key]
+                    except KeyError:
+                        indom = self._instance_name(info, key, instances, ambiguous)
+                data[info.name][indom] = [stamps[records[first:last]].tolist(),
+                                          vals[first:last].tolist()]
+
         return (data, skipped_metrics)
@@ -0,0 +1,189 @@
+# pcp2pdf_batch - pcp(1) report graphing utility
+# Copyright (C) 2014  Michele Baldessari
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston,
+# MA 02110-1301, USA.
+
+from __future__ import print_function
+from hashlib import sha1
+import multiprocessing
+import os
+import re
+import sys
+import traceback
+
+from pcp import pmapi
+import cpmapi as c_api
+
+from pcp2pdf_stats import PcpStats
+from pcp2pdf_archive import PcpHelp
+
+# Every worker is replaced after this many reports. Workers are forked
+# from the parent, so a fresh one costs nothing in imports or help texts
+# and it drops whatever matplotlib state the previous report left behind
+BATCH_MAXTASKS = 1
+
+# The batch currently being run. Set in the parent before the pool is
+# created so that the forked workers inherit it instead of unpickling it
+_batch = None
+
+def read_manifest(fname):
+    '''Parses a batch manifest. Every line contains the path to a PCP
+    archive optionally followed by the output pdf file name. Empty
+    lines and lines starting with '#' are ignored. Returns a list of
+    (archive, output) tuples where output can be None. Raises an
+    Exception if two lines write the same output file'''
+    entries = []
+    outputs = set()
+    with open(fname) as manifest:
+        for line in manifest:
+            line = line.strip()
+            if line == '' or line.startswith('#'):
+                continue
+            fields = line.split()
+            if len(fields) > 2:
+                raise Exception('Invalid manifest line: [%s]' % line)
+            output = None
+            if len(fields) == 2:
+                output = fields[1]
+                if os.path.abspath(output) in outputs:
+                    raise Exception('Duplicate output file: [%s]' % output)
+                outputs.add(os.path.abspath(output))
+            entries.append((fields[0], output))
+    return entries
+
+def archive_basename(archive):
+    '''Returns the base name of an archive given either by its base name
+    (20140510.08.47) or by one of its files (20140510.08.47.0). A suffix
+    is only stripped when it names a file of the archive, as the base
+    name itself usually ends in digits'''
+    (base, suffix) = os.path.splitext(archive)
+    if (re.match(r'^\.(\d+|meta|index)$', suffix) and
+            os.path.exists(base + '.meta')):
+        archive = base
+    return os.path.basename(archive)
+
+def archive_hostname(archive):
+    '''Returns the host that collected the metrics in an archive'''
+    context = pmapi.pmContext(c_api.PM_CONTEXT_ARCHIVE, archive)
+    return context.pmGetContextHostName()
+
+def _batch_init():
+    '''Pool initializer. The per-graph progress output of concurrent
+    reports would just interleave, so it is silenced in the workers'''
+    sys.stdout = open(os.devnull, 'w')
+
+def _batch_wrapper(entry):
+    '''Runs a single report within a pool worker. Returns a tuple
+    (archive, output, error) where error is None on success or
+    the formatted traceback of the failure'''
+    (archive, output) = entry
+    try:
+        stats = _batch.create_stats(archive)
+        stats.output(output_file=output)
+    except:
+        return (archive, output, traceback.format_exc())
+    return (archive, output, None)
+
+class PcpBatch(object):
+    '''Creates the reports of many archives within a single interpreter.
+    Imports and help texts are loaded once in the parent and all the
+    reports are scheduled on a shared pool of worker processes, which
+    sets the global concurrency limit'''
+    def __init__(self, entries, jobs=None, outdir='.', workdir=None, **kwargs):
+        '''kwargs are the PcpStats options used for every report. When
+        workdir is set every report keeps its intermediate results in a
+        subdirectory of it, so that failed reports resume on a rerun'''
+        self.entries = entries
+        self.jobs = jobs
+        self.outdir = outdir
+        self.workdir = workdir
+        self.kwargs = kwargs
+        self.pcphelp = PcpHelp()
+
+    def create_stats(self, archive):
+        '''Returns the PcpStats object for a single archive of the batch'''
+        # Pool workers are daemonic and cannot create their own pool, so
+        # the graphs of a single report are created serially
+        workdir = None
+        if self.workdir:
+            name = sha1(os.path.abspath(archive)).hexdigest()
+            workdir = os.path.join(self.workdir, name)
+        return PcpStats(archive, pcphelp=self.pcphelp, threaded=False,
+                        workdir=workdir, **self.kwargs)
+
+    def default_output(self, hostname, archive):
+        '''Output file used when the manifest does not specify one'''
+        return os.path.join(self.outdir, '{0}-{1}.pdf'.format(
+            hostname, archive_basename(archive)))
+
+    def resolve_outputs(self):
+        '''Fills in the default output of the manifest entries without one.
+        Returns a tuple (entries, results) where results are the failed
+        (archive, output, error) tuples of the entries that cannot be run:
+        archives that cannot be opened and the later ones of those writing
+        the same output file, which would otherwise silently overwrite
+        each other'''
+        entries = []
+        results = []
+        outputs = {}
+        for (archive, output) in self.entries:
+            if output is None:
+                try:
+                    output = self.default_output(archive_hostname(archive), archive)
+                except:
+                    results.append((archive, output, traceback.format_exc()))
+                    continue
+            path = os.path.abspath(output)
+            if path in outputs:
+                error = 'Output file {0} is also written by {1}'.format(
+                    output, outputs[path])
+                results.append((archive, output, error))
+                continue
+            outputs[path] = archive
+            entries.append((archive, output))
+        return (entries, results)
+
+    def run(self):
+        '''Creates all the reports. Returns a list of (archive, output, error)
+        tuples, one per manifest entry. The entries that could not be run
+        come first, followed by the others in completion order'''
+        global _batch
+        (entries, results) = self.resolve_outputs()
+        _batch = self
+        # Load the rendering stack once in the parent so that the forked
+        # workers do not each pay for the import
+        import matplotlib.pyplot
+        import pcp2pdf_style
+        pool = multiprocessing.Pool(self.jobs, initializer=_batch_init,
+                                    maxtasksperchild=BATCH_MAXTASKS)
+        for (archive, output, error) in pool.imap_unordered(_batch_wrapper,
+                                                            entries):
+            if error is None:
+                print('Done: {0} -> {1}'.format(archive, output))
+            results.append((archive, output, error))
+        pool.close()
+        pool.join()
+        _batch = None
+        return results
+
+    def print_summary(self, results):
+        '''Prints the per-archive outcome of a batch run'''
+        failed = [r for r in results if r[2] is not None]
+        print('Batch done: {0} reports, {1} failed'.format(len(results),
+                                                          len(failed)))
+        for (archive, output, error) in failed:
+            print('Failed: {0}'.format(archive))
+            print(error)
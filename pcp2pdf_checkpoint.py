@@ -0,0 +1,143 @@
+# pcp2pdf_checkpoint - pcp(1) report graphing utility
+# Copyright (C) 2014  Michele Baldessari
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston,
+# MA 02110-1301, USA.
+
+from __future__ import print_function
+import cPickle as pickle
+import json
+import os
+import shutil
+
+# File in the work directory holding the key of the run it belongs to
+KEY_FILE = 'checkpoint.key'
+# Present when the work directory existed (empty) before the first run,
+# in which case only the files the runs wrote into it are ever removed
+ADOPTED_FILE = 'checkpoint.adopted'
+# Log of the files written into an adopted work directory
+FILES_LOG = 'files'
+
+class Checkpoint(object):
+    '''Work directory of a resumable run. Every phase stores its results
+    in it together with a record of what was completed, so that a run
+    that was interrupted can continue where it stopped. The results of a
+    run with a different key are discarded. A directory that is not
+    created by the Checkpoint itself is never removed, only the files
+    written into it are. Raises ValueError if it is not empty and was
+    not used by a Checkpoint before'''
+    def __init__(self, workdir, key):
+        self.workdir = workdir
+        self.created = not os.path.exists(self.path(ADOPTED_FILE))
+        if os.path.isdir(workdir):
+            previous = self._read_key()
+            if previous is None:
+                if len(os.listdir(workdir)) > 0:
+                    raise ValueError('{0} is not empty and is not a work directory '
+                                     'created by a previous run'.format(workdir))
+                self.created = False
+            elif previous != key:
+                print('Discarding the previous run in {0}'.format(workdir))
+                self.remove()
+        # Files known to be written into an adopted work directory
+        self.tracked = set()
+        if not self.created:
+            self.tracked.update(self.records(FILES_LOG))
+        self.resumed = os.path.exists(self.path(KEY_FILE))
+        if not self.resumed:
+            if self.created:
+                os.makedirs(workdir)
+            else:
+                open(self.path(ADOPTED_FILE), 'w').close()
+            with open(self.path(KEY_FILE), 'w') as keyfile:
+                keyfile.write(key)
+
+    def _read_key(self):
+        try:
+            with open(self.path(KEY_FILE)) as keyfile:
+                return keyfile.read()
+        except IOError:
+            return None
+
+    def path(self, name):
+        return os.path.join(self.workdir, name)
+
+    def track(self, fnames):
+        '''Registers files about to be written into the work directory, so
+        that they are removed along with it. Only needed for files that are
+        not written by save or record'''
+        names = set([os.path.basename(fname) for fname in fnames]) - self.tracked
+        if self.created or not names:
+            return
+        with open(self.path(FILES_LOG + '.log'), 'a') as log:
+            for name in sorted(names):
+                log.write(json.dumps([name, True]) + '\n')
+            log.flush()
+            os.fsync(log.fileno())
+        self.tracked.update(names)
+
+    def save(self, name, obj):
+        '''Stores obj under name. The file is only renamed in place once
+        it was fully written, so it is either complete or missing'''
+        tmp = self.path(name + '.tmp')
+        self.track([name, name + '.tmp'])
+        with open(tmp, 'wb') as data:
+            pickle.dump(obj, data, pickle.HIGHEST_PROTOCOL)
+            data.flush()
+            os.fsync(data.fileno())
+        os.rename(tmp, self.path(name))
+
+    def load(self, name):
+        '''Returns the object stored under name or None'''
+        try:
+            with open(self.path(name), 'rb') as data:
+                return pickle.load(data)
+        except (IOError, EOFError, pickle.UnpicklingError):
+            return None
+
+    def record(self, name, key, value):
+        '''Appends a completed (key, value) item to the log called name'''
+        self.track([name + '.log'])
+        with open(self.path(name + '.log'), 'a') as log:
+            log.write(json.dumps([key, value]) + '\n')
+            log.flush()
+            os.fsync(log.fileno())
+
+    def records(self, name):
+        '''Returns a dictionary with the items of the log called name. A
+        line cut short by an interruption is ignored'''
+        items = {}
+        try:
+            with open(self.path(name + '.log')) as log:
+                for line in log:
+                    if not line.endswith('\n'):
+                        break
+                    (key, value) = json.loads(line)
+                    items[key] = value
+        except IOError:
+            pass
+        return items
+
+    def remove(self):
+        '''Removes the work directory, or only the files written into it
+        if it was not created by the Checkpoint'''
+        if self.created:
+            shutil.rmtree(self.workdir)
+            return
+        names = list(self.records(FILES_LOG)) + [FILES_LOG + '.log', KEY_FILE,
+                                                  ADOPTED_FILE]
+        for name in names:
+            if os.path.exists(self.path(name)):
+                os.unlink(self.path(name))
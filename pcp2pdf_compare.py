@@ -0,0 +1,191 @@
+# pcp2pdf_compare - pcp(1) report graphing utility
+# Copyright (C) 2014  Michele Baldessari
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston,
+# MA 02110-1301, USA.
+
+from __future__ import print_function
+import os
+import shutil
+import sys
+import tempfile
+
+from pcp2pdf_score import SeriesSummary, ks_statistic, mean_shift
+from pcp2pdf_stats import GRAPH_SIZE, heading, progress_callback
+
+# Number of most divergent metrics that get a graph
+COMPARE_TOP = 20
+# Maximum number of instances drawn in a single comparison graph
+COMPARE_MAX_INSTANCES = 8
+# Maximum number of rows of the ranking table
+COMPARE_TABLE_ROWS = 50
+
+class PcpCompare(object):
+    '''Compares a baseline with an incident. Both are PcpStats objects,
+    either of two different archives or of two time windows of the same
+    one. Every instance of the metrics found in both is summarized, the
+    metrics are ranked by how much their distribution changed and only
+    the top ones are graphed, overlaid on the time relative to the start
+    of each window'''
+    def __init__(self, baseline, incident, top=None):
+        self.baseline = baseline
+        self.incident = incident
+        if top is None:
+            top = COMPARE_TOP
+        self.top = top
+        self.story = []
+        self.tempdir = None
+
+    def _origin(self, stats):
+        '''Returns the datetime the relative time of a window starts from'''
+        if stats.pcparchive.start:
+            return stats.pcparchive.start
+        return stats.pcparchive.get_timeinterval()[0]
+
+    def rank(self):
+        '''Returns a list of (ks, shift, metric, indom, baseline_summary,
+        incident_summary) tuples for every numeric series found in both
+        windows, most divergent first'''
+        ranking = []
+        for metric in sorted(self.incident.all_data):
+            if metric not in self.baseline.all_data:
+                continue
+            if (self.incident.is_string_metric(metric) or
+                self.baseline.is_string_metric(metric)):
+                continue
+            for indom in self.incident.all_data[metric]:
+                if indom not in self.baseline.all_data[metric]:
+                    continue
+                first = SeriesSummary(self.baseline.all_data[metric][indom][1])
+                second = SeriesSummary(self.incident.all_data[metric][indom][1])
+                ranking.append((ks_statistic(first, second), mean_shift(first, second),
+                                metric, indom, first, second))
+        ranking.sort(key=lambda x: (x[0], x[1]), reverse=True)
+        return ranking
+
+    def create_graph(self, fname, metric, indoms):
+        '''Creates an image with the baseline and incident series of the given
+        instances of a metric overlaid on relative time'''
+        import matplotlib
+        import matplotlib.pyplot as plt
+
+        fig = plt.figure(figsize=(GRAPH_SIZE[0], GRAPH_SIZE[1]))
+        axes = fig.add_subplot(111)
+        axes.set_xlabel('Hours since the start of the window')
+        axes.set_ylabel(metric)
+        axes.set_title('{0} baseline vs incident'.format(metric))
+        cmap = plt.get_cmap('Set1')
+        for (counter, indom) in enumerate(indoms):
+            color = cmap(counter % 9)
+            label = metric if indom == 0 else str(indom)
+            for (stats, style, suffix) in [(self.baseline, '--', 'baseline'),
+                                           (self.incident, '-', 'incident')]:
+                (timestamps, values) = stats.all_data[metric][indom]
+                origin = self._origin(stats)
+                hours = [(t - origin).total_seconds() / 3600.0 for t in timestamps]
+                axes.plot(hours, values, style, color=color,
+                          label='{0} ({1})'.format(label, suffix))
+        axes.grid(True)
+        fontproperties = matplotlib.font_manager.FontProperties(size='xx-small')
+        lgd = axes.legend(loc=1, shadow=True, prop=fontproperties)
+        plt.savefig(fname, bbox_extra_artists=(lgd,), bbox_inches='tight')
+        plt.close('all')
+
+    def output(self, output_file='output.pdf'):
+        from reportlab.platypus.paragraph import Paragraph
+        from reportlab.platypus import PageBreak, Image, Spacer, Table
+        from reportlab.lib.pagesizes import A4, landscape
+        from reportlab.lib.units import inch
+        from pcp2pdf_style import PcpDocTemplate, tablestyle
+
+        for (stats, name) in [(self.baseline, 'baseline'), (self.incident, 'incident')]:
+            sys.stdout.write('Parsing {0} archive: '.format(name))
+            sys.stdout.flush()
+            stats.parse()
+            print()
+
+        ranking = self.rank()
+        # Keep the instances of the top metrics in rank order
+        top_metrics = []
+        top_indoms = {}
+        for (ks, shift, metric, indom, first, second) in ranking:
+            if metric not in top_indoms:
+                if len(top_metrics) == self.top:
+                    continue
+                top_metrics.append(metric)
+                top_indoms[metric] = []
+            if len(top_indoms[metric]) < COMPARE_MAX_INSTANCES:
+                top_indoms[metric].append(indom)
+
+        # Using /var/tmp as /tmp is ram-mounted these days
+        self.tempdir = tempfile.mkdtemp(prefix='pcpstats', dir='/var/tmp')
+        try:
+            print('Creating graphs: ', end='')
+            graphs = []
+            for metric in top_metrics:
+                fname = os.path.join(self.tempdir, metric + '.png')
+                self.create_graph(fname, metric, top_indoms[metric])
+                progress_callback(True)
+                graphs.append((metric, fname))
+            print()
+
+            doc = PcpDocTemplate(output_file, pagesize=landscape(A4))
+            title = '%s vs %s' % (self.baseline.pcparchive.get_hostname(),
+                                  self.incident.pcparchive.get_hostname())
+            self.story.append(Paragraph(title, doc.centered))
+            self.story.append(Spacer(1, 0.05 * inch))
+            for (stats, name) in [(self.baseline, 'Baseline'), (self.incident, 'Incident')]:
+                (start, end) = stats.pcparchive.get_timeinterval()
+                start = stats.pcparchive.start or start
+                end = stats.pcparchive.end or end
+                self.story.append(Paragraph('%s: %s (%s - %s)' % (name, stats.args, start, end),
+                                            doc.small_centered))
+            self.story.append(heading('Table of contents', doc.centered_index))
+            self.story.append(doc.toc)
+            self.story.append(PageBreak())
+
+            self.story.append(heading('Ranking', doc.h1))
+            self.story.append(Spacer(1, 0.2 * inch))
+            data = [('Metric', 'Instance', 'KS', 'Mean (baseline)', 'Mean (incident)',
+                     'p95 (baseline)', 'p95 (incident)')]
+            for (ks, shift, metric, indom, first, second) in ranking[:COMPARE_TABLE_ROWS]:
+                data.append((metric, '' if indom == 0 else indom, '%.2f' % ks,
+                             '%.6g' % first.mean, '%.6g' % second.mean,
+                             '%.6g' % first.p95, '%.6g' % second.p95))
+            table = Table(data)
+            table.setStyle(tablestyle)
+            self.story.append(table)
+            self.story.append(PageBreak())
+
+            print("Building pdf: ", end='')
+            last_category = ''
+            for (metric, fname) in graphs:
+                category = self.incident.get_category(metric)
+                if last_category != category:
+                    self.story.append(heading(category, doc.h1))
+                    last_category = category
+                self.story.append(heading(metric, doc.h2_invisible))
+                self.story.append(Image(fname, width=GRAPH_SIZE[0]*inch,
+                                  height=GRAPH_SIZE[1]*inch))
+                self.story.append(PageBreak())
+                sys.stdout.write('.')
+                sys.stdout.flush()
+
+            doc.multiBuild(self.story)
+        finally:
+            shutil.rmtree(self.tempdir)
+        print()
+        print("Done building: {0}".format(output_file))
+        print("Done removing: {0}".format(self.tempdir))
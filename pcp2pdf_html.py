@@ -0,0 +1,351 @@
+# pcp2pdf_html - pcp(1) report graphing utility
+# Copyright (C) 2014  Michele Baldessari
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston,
+# MA 02110-1301, USA.
+
+from __future__ import print_function
+import json
+import os
+import sys
+from xml.sax.saxutils import escape
+
+import numpy
+
+from pcp2pdf_series import to_seconds
+
+# Points per series of the coarsest resolution level. Every following
+# level has LEVEL_FACTOR times more points, the last one has them all
+LEVEL_POINTS = 1000
+LEVEL_FACTOR = 4
+
+# Extra entities to escape within html attributes
+QUOTE = {'"': '&quot;'}
+
+def decimate(seconds, values, points):
+    '''Reduces a series to about points samples. The series is split in
+    points / 2 chunks and the minimum and maximum of every chunk are kept,
+    so that spikes survive the reduction. Returns (seconds, values)'''
+    count = len(values)
+    chunk = int(numpy.ceil(count / (points / 2.0)))
+    if chunk <= 1:
+        return (seconds, values)
+    padded = numpy.concatenate([values, numpy.repeat(values[-1:], -count % chunk)])
+    padded = padded.reshape(-1, chunk)
+    base = numpy.arange(len(padded)) * chunk
+    idx = numpy.unique(numpy.concatenate([base + padded.argmin(axis=1),
+                                          base + padded.argmax(axis=1)]))
+    idx = idx[idx < count]
+    return (seconds[idx], values[idx])
+
+def levels(seconds, values):
+    '''Returns the list of resolution levels of a series, coarsest first.
+    Every level is a pair [seconds, values] of lists'''
+    ret = []
+    points = LEVEL_POINTS
+    while points < len(values):
+        (secs, vals) = decimate(seconds, values, points)
+        ret.append([secs, vals])
+        points *= LEVEL_FACTOR
+    ret.append([seconds, values])
+    return [[numpy.round(secs, 3).tolist(), [float('%.6g' % v) for v in vals]]
+            for (secs, vals) in ret]
+
+class PcpHtmlReport(object):
+    '''Writes a report as an html page that opens from disk without any
+    server. The series of every category are written in their own
+    javascript file in a <output>_data directory and only loaded once
+    the category is opened in the browser. Graphs are drawn client-side
+    from multiple resolution levels, picking finer ones when zooming.
+    matplotlib is not used at all'''
+    def __init__(self, stats):
+        self.stats = stats
+
+    def _graph(self, label, metrics, text):
+        '''Returns the dictionary describing a single graph'''
+        series = []
+        for metric in metrics:
+            values = self.stats.all_data[metric]
+            for indom in sorted(values):
+                (timestamps, dataset) = values[indom]
+                if len(timestamps) <= 1:
+                    continue
+                if indom == 0:
+                    name = metric
+                elif len(metrics) > 1:
+                    name = '%s %s' % (metric, indom)
+                else:
+                    name = '%s' % indom
+                series.append({'name': name,
+                               'levels': levels(to_seconds(timestamps),
+                                                numpy.asarray(dataset, dtype=numpy.float64))})
+        return {'label': label, 'text': text or '', 'series': series}
+
+    def output(self, output_file):
+        stats = self.stats
+        sys.stdout.write('Parsing archive: ')
+        sys.stdout.flush()
+        rate_converted = stats.parse()
+        print()
+        (string_metrics, scores) = stats.prepare_graphs(rate_converted)
+
+        datadir = os.path.splitext(output_file)[0] + '_data'
+        if not os.path.isdir(datadir):
+            os.makedirs(datadir)
+
+        # Group the graphs by category keeping their order
+        categories = []
+        graphs = {}
+        for (label, fname, metrics, text) in stats.all_graphs:
+            category = stats.get_category(metrics)
+            if category not in graphs:
+                categories.append(category)
+                graphs[category] = []
+            graphs[category].append((label, metrics, text))
+
+        print('Writing data: ', end='')
+        sections = []
+        for (i, category) in enumerate(categories):
+            chunk = 'c%d.js' % i
+            data = [self._graph(label, metrics, text)
+                    for (label, metrics, text) in graphs[category]]
+            data = [g for g in data if len(g['series']) > 0]
+            if len(data) == 0:
+                continue
+            with open(os.path.join(datadir, chunk), 'w') as out:
+                out.write('pcp2pdf.load(%s, %s);\n' % (json.dumps(category),
+                                                       json.dumps(data, separators=(',', ':'))))
+            sections.append(SECTION.format(category=escape(category, QUOTE),
+                                           count=len(data),
+                                           src=escape(os.path.basename(datadir) +
+                                                      '/' + chunk, QUOTE)))
+            sys.stdout.write('.')
+            sys.stdout.flush()
+        print()
+
+        rows = []
+        for (metric, ts, value) in stats.string_metrics_table(string_metrics)[1:]:
+            rows.append('<tr><td>%s</td><td>%s</td><td>%s</td></tr>' % (
+                        escape(metric), escape(ts), escape(value)))
+        strings = ''
+        if len(rows) > 0:
+            strings = STRINGS.format(rows='\n'.join(rows))
+
+        with open(output_file, 'w') as out:
+            out.write(PAGE.format(hostname=escape(stats.pcparchive.get_hostname()),
+                                  args=escape(stats.args),
+                                  sections='\n'.join(sections), strings=strings,
+                                  script=SCRIPT))
+        print("Done building: {0}".format(output_file))
+
+SECTION = '''<details data-src="{src}">
+<summary>{category} ({count} graphs)</summary>
+<div class="graphs" data-category="{category}"></div>
+</details>'''
+
+STRINGS = '''<details>
+<summary>String metrics</summary>
+<table>
+<tr><th>Metric</th><th>Timestamp</th><th>Value</th></tr>
+{rows}
+</table>
+</details>'''
+
+PAGE = '''<!DOCTYPE html>
+<html>
+<head>
+<meta charset="utf-8">
+<title>{hostname}</title>
+<style>
+body {{ font-family: sans-serif; margin: 1em 2em; }}
+h1 {{ text-align: center; }}
+.args {{ text-align: center; color: #555; }}
+summary {{ font-size: 1.3em; font-weight: bold; cursor: pointer; padding: 0.3em 0; }}
+.graph {{ margin: 1em 0 2em 0; }}
+.graph canvas {{ border: 1px solid #ccc; cursor: crosshair; }}
+.legend {{ font-size: 0.7em; max-height: 6em; overflow-y: auto; }}
+.legend span {{ display: inline-block; margin-right: 1em; }}
+.text {{ font-size: 0.9em; }}
+table {{ border-collapse: collapse; font-size: 0.8em; }}
+td, th {{ border: 1px solid #000; padding: 0 3px; text-align: left; }}
+</style>
+</head>
+<body>
+<h1>{hostname}</h1>
+<p class="args">{args}</p>
+<p class="args">Open a section to load its graphs. Drag over a graph to zoom, double click to reset.</p>
+{sections}
+{strings}
+<script>
+{script}
+</script>
+</body>
+</html>
+'''
+
+SCRIPT = r'''
+var pcp2pdf = (function() {
+  var WIDTH = 1000, HEIGHT = 400, MARGIN = 60;
+  var COLORS = ['#e41a1c', '#377eb8', '#4daf4a', '#984ea3', '#ff7f00',
+                '#a65628', '#f781bf', '#999999', '#17becf', '#bcbd22'];
+
+  function pad(n) { return (n < 10 ? '0' : '') + n; }
+  function fmtTime(secs) {
+    // Timestamps are archive local times stored as if they were UTC
+    var d = new Date(secs * 1000);
+    return pad(d.getUTCMonth() + 1) + '-' + pad(d.getUTCDate()) + ' ' +
+           pad(d.getUTCHours()) + ':' + pad(d.getUTCMinutes()) + ':' +
+           pad(d.getUTCSeconds());
+  }
+  function lowerBound(arr, x) {
+    var lo = 0, hi = arr.length;
+    while (lo < hi) {
+      var mid = (lo + hi) >> 1;
+      if (arr[mid] < x) { lo = mid + 1; } else { hi = mid; }
+    }
+    return lo;
+  }
+  // Coarsest level that has enough points within [t0, t1]
+  function pickLevel(levels, t0, t1) {
+    for (var i = 0; i < levels.length; i++) {
+      var t = levels[i][0];
+      if (lowerBound(t, t1) - lowerBound(t, t0) >= WIDTH) { return levels[i]; }
+    }
+    return levels[levels.length - 1];
+  }
+
+  function draw(graph, canvas, t0, t1) {
+    var ctx = canvas.getContext('2d');
+    ctx.clearRect(0, 0, canvas.width, canvas.height);
+    var visible = [], vmin = Infinity, vmax = -Infinity;
+    graph.series.forEach(function(s) {
+      var level = pickLevel(s.levels, t0, t1);
+      var a = Math.max(lowerBound(level[0], t0) - 1, 0);
+      var b = Math.min(lowerBound(level[0], t1) + 1, level[0].length);
+      for (var i = a; i < b; i++) {
+        vmin = Math.min(vmin, level[1][i]);
+        vmax = Math.max(vmax, level[1][i]);
+      }
+      visible.push([level, a, b]);
+    });
+    if (vmin === Infinity) { return; }
+    if (vmin === vmax) { vmin -= 1; vmax += 1; }
+    var w = canvas.width - 2 * MARGIN, h = canvas.height - 2 * MARGIN;
+    var x = function(t) { return MARGIN + (t - t0) / (t1 - t0) * w; };
+    var y = function(v) { return MARGIN + h - (v - vmin) / (vmax - vmin) * h; };
+
+    ctx.strokeStyle = '#000';
+    ctx.strokeRect(MARGIN, MARGIN, w, h);
+    ctx.fillStyle = '#000';
+    ctx.font = '11px sans-serif';
+    for (var i = 0; i <= 4; i++) {
+      var v = vmin + (vmax - vmin) * i / 4, t = t0 + (t1 - t0) * i / 4;
+      ctx.textAlign = 'right';
+      ctx.fillText(v.toPrecision(4), MARGIN - 4, y(v) + 4);
+      ctx.textAlign = 'center';
+      ctx.fillText(fmtTime(t), x(t), MARGIN + h + 16);
+    }
+    ctx.save();
+    ctx.beginPath();
+    ctx.rect(MARGIN, MARGIN, w, h);
+    ctx.clip();
+    visible.forEach(function(item, n) {
+      var level = item[0];
+      ctx.strokeStyle = COLORS[n % COLORS.length];
+      ctx.beginPath();
+      for (var i = item[1]; i < item[2]; i++) {
+        var px = x(level[0][i]), py = y(level[1][i]);
+        if (i === item[1]) { ctx.moveTo(px, py); } else { ctx.lineTo(px, py); }
+      }
+      ctx.stroke();
+    });
+    ctx.restore();
+  }
+
+  function render(graph, container) {
+    var div = document.createElement('div');
+    div.className = 'graph';
+    var title = document.createElement('h3');
+    title.textContent = graph.label;
+    var canvas = document.createElement('canvas');
+    canvas.width = WIDTH + 2 * MARGIN;
+    canvas.height = HEIGHT + 2 * MARGIN;
+    var legend = document.createElement('div');
+    legend.className = 'legend';
+    graph.series.forEach(function(s, n) {
+      var span = document.createElement('span');
+      span.style.color = COLORS[n % COLORS.length];
+      span.textContent = s.name;
+      legend.appendChild(span);
+    });
+    var text = document.createElement('p');
+    text.className = 'text';
+    text.innerHTML = graph.text;
+    div.appendChild(title);
+    div.appendChild(canvas);
+    if (graph.series.length > 1) { div.appendChild(legend); }
+    div.appendChild(text);
+    container.appendChild(div);
+
+    var tmin = Infinity, tmax = -Infinity;
+    graph.series.forEach(function(s) {
+      var t = s.levels[s.levels.length - 1][0];
+      tmin = Math.min(tmin, t[0]);
+      tmax = Math.max(tmax, t[t.length - 1]);
+    });
+    var view = [tmin, tmax], start = null;
+    var toTime = function(ev) {
+      var px = ev.clientX - canvas.getBoundingClientRect().left;
+      var w = canvas.width - 2 * MARGIN;
+      return view[0] + (px - MARGIN) / w * (view[1] - view[0]);
+    };
+    canvas.addEventListener('mousedown', function(ev) { start = toTime(ev); });
+    canvas.addEventListener('mouseup', function(ev) {
+      var end = toTime(ev);
+      if (start !== null && Math.abs(end - start) > 0) {
+        view = [Math.max(Math.min(start, end), tmin), Math.min(Math.max(start, end), tmax)];
+        draw(graph, canvas, view[0], view[1]);
+      }
+      start = null;
+    });
+    canvas.addEventListener('dblclick', function() {
+      view = [tmin, tmax];
+      draw(graph, canvas, tmin, tmax);
+    });
+    draw(graph, canvas, tmin, tmax);
+  }
+
+  // Series are only loaded when their section is opened. Injecting a
+  // script element works from file:// where XMLHttpRequest does not
+  Array.prototype.forEach.call(document.querySelectorAll('details[data-src]'),
+    function(details) {
+      details.addEventListener('toggle', function() {
+        if (!details.open || details.loaded) { return; }
+        details.loaded = true;
+        var script = document.createElement('script');
+        script.src = details.getAttribute('data-src');
+        document.body.appendChild(script);
+      });
+    });
+
+  return {
+    load: function(category, graphs) {
+      var selector = 'div.graphs[data-category="' + category + '"]';
+      var container = document.querySelector(selector);
+      graphs.forEach(function(graph) { render(graph, container); });
+    }
+  };
+})();
+'''
@@ -0,0 +1,136 @@
+# pcp2pdf_scheduler - pcp(1) report graphing utility
+# Copyright (C) 2014  Michele Baldessari
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston,
+# MA 02110-1301, USA.
+
+import multiprocessing
+import os
+import Queue
+import resource
+import traceback
+
+def rss_mb():
+    '''Returns the current resident set size of the process in MB'''
+    try:
+        with open('/proc/self/statm') as statm:
+            pages = int(statm.read().split()[1])
+        return pages * resource.getpagesize() / (1024.0 * 1024.0)
+    except (IOError, IndexError, ValueError):
+        # Peak usage, in KB on Linux
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.0
+
+def _worker(func, obj, tasks, results, max_tasks, max_rss):
+    '''Worker process loop. Runs func(obj, job) for every (idx, job) received
+    on tasks and sends (pid, idx, ok, result) back on results, where result
+    is the traceback on failure. Exits on None or once the worker did
+    max_tasks jobs or grew beyond max_rss MB'''
+    pid = os.getpid()
+    done = 0
+    while True:
+        item = tasks.get()
+        if item is None:
+            break
+        (idx, job) = item
+        try:
+            results.put((pid, idx, True, func(obj, job)))
+        except Exception:
+            results.put((pid, idx, False, traceback.format_exc()))
+        done += 1
+        if ((max_tasks and done >= max_tasks) or
+            (max_rss and rss_mb() >= max_rss)):
+            break
+    results.put((pid, None, None, None))
+
+class RenderScheduler(object):
+    '''Runs func(obj, job) for a list of jobs in worker processes. obj is
+    inherited by the forked workers, so only the (small) jobs are sent to
+    them. Jobs are handed out one at a time to idle workers in the given
+    order. Workers are replaced after max_tasks jobs or when their resident
+    memory exceeds max_rss MB. A job raising an exception or killing its
+    worker is reported as failed and does not stop the others'''
+    def __init__(self, func, obj, workers=None, max_tasks=None, max_rss=None):
+        self.func = func
+        self.obj = obj
+        self.workers = workers or multiprocessing.cpu_count()
+        self.max_tasks = max_tasks
+        self.max_rss = max_rss
+        self.results = multiprocessing.Queue()
+        # pid -> [process, tasks queue, index of the running job or None]
+        self.running = {}
+
+    def _spawn(self):
+        tasks = multiprocessing.Queue()
+        process = multiprocessing.Process(target=_worker,
+                                          args=(self.func, self.obj, tasks, self.results,
+                                                self.max_tasks, self.max_rss))
+        process.daemon = True
+        process.start()
+        self.running[process.pid] = [process, tasks, None]
+
+    def _retire(self, pid):
+        (process, tasks, idx) = self.running.pop(pid)
+        process.join()
+        return idx
+
+    def imap_unordered(self, jobs):
+        '''Yields (job, ok, result) tuples as jobs complete'''
+        pending = list(enumerate(jobs))
+        pending.reverse()
+        remaining = len(pending)
+        for i in range(min(self.workers, len(pending))):
+            self._spawn()
+
+        while remaining > 0:
+            # Hand out jobs to the idle workers
+            for (pid, worker) in self.running.items():
+                if worker[2] is None and len(pending) > 0:
+                    (idx, job) = pending.pop()
+                    worker[2] = idx
+                    worker[1].put((idx, job))
+
+            try:
+                (pid, idx, ok, result) = self.results.get(timeout=1)
+            except Queue.Empty:
+                # Workers that died without reporting take their job with them
+                for pid in [p for p in self.running if not self.running[p][0].is_alive()]:
+                    process = self.running[pid][0]
+                    idx = self._retire(pid)
+                    if idx is not None:
+                        remaining -= 1
+                        yield (jobs[idx], False, 'Worker died with exit code %s' %
+                               process.exitcode)
+                    if len(pending) > 0:
+                        self._spawn()
+                continue
+
+            if pid not in self.running:
+                continue
+            if idx is None:
+                # The worker recycled itself. A job it was handed meanwhile
+                # goes back to the front of the queue
+                idx = self._retire(pid)
+                if idx is not None:
+                    pending.append((idx, jobs[idx]))
+                if len(pending) > 0:
+                    self._spawn()
+                continue
+            self.running[pid][2] = None
+            remaining -= 1
+            yield (jobs[idx], ok, result)
+
+        for pid in list(self.running):
+            self.running[pid][1].put(None)
+            self._retire(pid)
@@ -0,0 +1,108 @@
+# pcp2pdf_score - pcp(1) report graphing utility
+# Copyright (C) 2014  Michele Baldessari
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston,
+# MA 02110-1301, USA.
+
+'''Compact per-series summaries and the scores computed from them'''
+
+import numpy
+
+# Percentiles kept in a summary. The 95th percentile is one of them
+QUANTILES = numpy.linspace(0, 100, 21)
+
+class SeriesSummary(object):
+    '''Compact summary of the values of a single series. It is small enough
+    to be kept for every series of an archive and is all that is needed
+    to compare the distributions of two series'''
+    __slots__ = ('count', 'mean', 'quantiles')
+
+    def __init__(self, values):
+        values = numpy.asarray(values, dtype=numpy.float64)
+        values = values[numpy.isfinite(values)]
+        self.count = len(values)
+        if self.count == 0:
+            self.mean = numpy.nan
+            self.quantiles = numpy.empty(len(QUANTILES))
+            self.quantiles.fill(numpy.nan)
+        else:
+            self.mean = values.mean()
+            self.quantiles = numpy.percentile(values, QUANTILES)
+
+    @property
+    def p95(self):
+        return self.quantiles[-2]
+
+def ks_statistic(first, second):
+    '''Two sample Kolmogorov-Smirnov statistic of two SeriesSummary objects,
+    i.e. the largest distance between their cumulative distributions. The
+    quantiles of each summary stand for the full sample. Returns a value
+    between 0 (same distribution) and 1'''
+    if first.count == 0 or second.count == 0:
+        return 0.0
+    points = numpy.concatenate([first.quantiles, second.quantiles])
+    cdf1 = numpy.searchsorted(first.quantiles, points, side='right') / float(len(QUANTILES))
+    cdf2 = numpy.searchsorted(second.quantiles, points, side='right') / float(len(QUANTILES))
+    return float(numpy.abs(cdf1 - cdf2).max())
+
+def mean_shift(first, second):
+    '''Relative change of the mean between two SeriesSummary objects'''
+    if first.count == 0 or second.count == 0:
+        return 0.0
+    scale = max(abs(first.mean), abs(second.mean))
+    if scale == 0:
+        return 0.0
+    return float(abs(second.mean - first.mean) / scale)
+
+def interest_score(values):
+    '''Scores how interesting a series is to look at. Returns a tuple
+    (score, variability, change, spike) where each component is between
+    0 and 1 and score is their sum:
+    variability: coefficient of variation
+    change: largest difference between the mean before and after any
+            point in time, relative to the standard deviation and
+            discounted towards the edges of the series
+    spike: largest distance from the median in median absolute
+           deviations, on a log scale where 100 deviations is 1'''
+    values = numpy.asarray(values, dtype=numpy.float64)
+    values = values[numpy.isfinite(values)]
+    count = len(values)
+    if count < 2:
+        return (0.0, 0.0, 0.0, 0.0)
+    std = values.std()
+    if std == 0:
+        return (0.0, 0.0, 0.0, 0.0)
+    mean = values.mean()
+    if mean == 0:
+        variability = 1.0
+    else:
+        variability = min(float(std / abs(mean)), 1.0)
+
+    # Mean of the first k values and of the remaining ones for every k
+    cumsum = numpy.cumsum(values)[:-1]
+    split = numpy.arange(1, count)
+    before = cumsum / split
+    after = (cumsum[-1] + values[-1] - cumsum) / (count - split)
+    weight = 2 * numpy.sqrt(split * (count - split)) / count
+    change = min(float((numpy.abs(before - after) * weight).max() / std), 1.0)
+
+    median = numpy.median(values)
+    deviation = numpy.abs(values - median)
+    mad = 1.4826 * numpy.median(deviation)
+    if mad == 0:
+        mad = std
+    spike = min(float(numpy.log10(1 + deviation.max() / mad) / 2), 1.0)
+
+    return (variability + change + spike, variability, change, spike)
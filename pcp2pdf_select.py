@@ -0,0 +1,213 @@
+# pcp2pdf_select - pcp(1) report graphing utility
+# Copyright (C) 2014  Michele Baldessari
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston,
+# MA 02110-1301, USA.
+
+'''Selection of the metrics of a report out of the PMNS of an archive'''
+
+import fnmatch
+import os
+import re
+
+# Named selection sets usable with --profile. More can be defined in
+# PROFILES_FILE, one per line: <name> <selector1> <selector2> ...
+PROFILES = {
+    'cpu': ['tree:kernel.all.cpu', 'tree:kernel.percpu.cpu', 'tree:kernel.all.load',
+            'tree:kernel.all.pswitch', 'tree:kernel.all.intr', 'tree:proc.runq'],
+    'memory': ['tree:mem', 'tree:swap'],
+    'disk': ['tree:disk', 'tree:filesys', 'tree:vfs'],
+    'network': ['tree:network'],
+}
+PROFILES_FILE = os.path.expanduser('~/.pcp2pdf_profiles')
+
+# Characters with a special meaning in a regular expression
+REGEX_SPECIAL = '.^$*+?{}[]\\|()'
+
+class MetricTrie(object):
+    '''Prefix tree of metric names with one level per PMNS component, so
+    that a selector only visits the part of the namespace it can match'''
+    def __init__(self, names):
+        self.root = {}
+        for name in names:
+            node = self.root
+            for part in name.split('.'):
+                node = node.setdefault(part, {})
+            # None can never be a component, so it marks a leaf
+            node[None] = name
+
+    def _leaves(self, node):
+        '''Returns all the metric names below node'''
+        names = []
+        stack = [node]
+        while stack:
+            node = stack.pop()
+            for (part, child) in node.items():
+                if part is None:
+                    names.append(child)
+                else:
+                    stack.append(child)
+        return names
+
+    def subtree(self, prefix):
+        '''Returns the metrics below a PMNS node, e.g. network.interface.
+        An empty prefix returns all of them'''
+        node = self.root
+        for part in prefix.split('.') if prefix else []:
+            if part not in node:
+                return []
+            node = node[part]
+        return self._leaves(node)
+
+    def glob(self, pattern):
+        '''Returns the metrics matching a shell-like pattern, which is
+        matched one component at a time: '*' does not cross a dot while a
+        '**' component matches any number of components'''
+        names = []
+        stack = [(self.root, pattern.split('.'))]
+        while stack:
+            (node, parts) = stack.pop()
+            if not parts:
+                if None in node:
+                    names.append(node[None])
+                continue
+            (part, rest) = (parts[0], parts[1:])
+            if part == '**':
+                stack.append((node, rest))
+                for (child_part, child) in node.items():
+                    if child_part is not None:
+                        stack.append((child, parts))
+            elif not any([c in part for c in '*?[']):
+                if part in node:
+                    stack.append((node[part], rest))
+            else:
+                for (child_part, child) in node.items():
+                    if child_part is not None and fnmatch.fnmatchcase(child_part, part):
+                        stack.append((child, rest))
+        # '**' can reach a leaf through several paths
+        return list(set(names))
+
+    def match(self, regex, compiled):
+        '''Returns the metrics matching a regular expression from their
+        start, like re.match. Only the subtrees matching the literal
+        prefix of the expression are searched'''
+        literal = literal_prefix(regex)
+        parts = literal.split('.')
+        node = self.root
+        for part in parts[:-1]:
+            if part not in node:
+                return []
+            node = node[part]
+        nodes = [child for (part, child) in node.items()
+                 if part is not None and part.startswith(parts[-1])]
+        names = []
+        for node in nodes:
+            names.extend([name for name in self._leaves(node) if compiled.match(name)])
+        return names
+
+def literal_prefix(regex):
+    '''Returns the text every match of a regular expression starts with'''
+    if '|' in regex:
+        return ''
+    if regex.startswith('^'):
+        regex = regex[1:]
+    prefix = ''
+    i = 0
+    while i < len(regex):
+        char = regex[i]
+        if char == '\\' and i + 1 < len(regex) and regex[i + 1] in REGEX_SPECIAL:
+            (char, step) = (regex[i + 1], 2)
+        elif char in REGEX_SPECIAL:
+            break
+        else:
+            step = 1
+        # A quantifier makes the last character optional
+        if i + step < len(regex) and regex[i + step] in '*?{':
+            break
+        prefix += char
+        i += step
+    return prefix
+
+def load_profiles(fname=PROFILES_FILE):
+    '''Returns the built-in profiles updated with the ones in fname'''
+    profiles = dict(PROFILES)
+    if not os.path.exists(fname):
+        return profiles
+    with open(fname) as lines:
+        for line in lines:
+            line = line.strip()
+            if line == '' or line.startswith('#'):
+                continue
+            fields = line.split()
+            profiles[fields[0]] = fields[1:]
+    return profiles
+
+class MetricSelector(object):
+    '''Resolves the --include, --exclude and --profile options to a list of
+    metrics. Every selector is one of:
+    tree:<node>     all the metrics below a PMNS node
+    glob:<pattern>  shell-like pattern matched one component at a time
+    re:<regex>      regular expression matched from the start of the name
+    <regex>         same as re:<regex>
+    Profiles are named lists of selectors that are added to the includes.
+    The selector is not tied to an archive, so it can be reused for all
+    the archives of a batch. Raises ValueError on invalid selectors'''
+    def __init__(self, includes=None, excludes=None, profiles=None,
+                 profiles_file=PROFILES_FILE):
+        includes = list(includes or [])
+        if profiles:
+            known = load_profiles(profiles_file)
+            for name in profiles:
+                if name not in known:
+                    raise ValueError('Unknown profile: {0}'.format(name))
+                includes.extend(known[name])
+        self.includes = [self._parse(text) for text in includes]
+        self.excludes = [self._parse(text) for text in excludes or []]
+
+    def _parse(self, text):
+        (kind, arg) = ('re', text)
+        if ':' in text and text.split(':', 1)[0] in ('tree', 'glob', 're'):
+            (kind, arg) = text.split(':', 1)
+        compiled = None
+        if kind == 're':
+            try:
+                compiled = re.compile(arg)
+            except re.error:
+                raise ValueError('Failed to parse: {0}'.format(text))
+        return (kind, arg, compiled)
+
+    def _resolve(self, trie, selectors):
+        names = set()
+        for (kind, arg, compiled) in selectors:
+            if kind == 'tree':
+                names.update(trie.subtree(arg))
+            elif kind == 'glob':
+                names.update(trie.glob(arg))
+            else:
+                names.update(trie.match(arg, compiled))
+        return names
+
+    def select(self, names):
+        '''Returns the sorted list of the given metric names that are
+        selected. Without includes all the metrics are, minus the excluded
+        ones. Included metrics are always selected, even when excluded'''
+        if not self.includes and not self.excludes:
+            return sorted(names)
+        trie = MetricTrie(names)
+        selected = set()
+        if self.excludes:
+            selected = set(names) - self._resolve(trie, self.excludes)
+        selected.update(self._resolve(trie, self.includes))
+        return sorted(selected)
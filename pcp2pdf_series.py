@@ -0,0 +1,307 @@
+# pcp2pdf_series - pcp(1) report graphing utility
+# Copyright (C) 2014  Michele Baldessari
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston,
+# MA 02110-1301, USA.
+
+'''Vectorized operations over the parsed time series. A series is the
+[timestamps, values] pair stored for every instance of a metric in
+PcpStats.all_data'''
+
+from datetime import datetime, timedelta
+import re
+
+import numpy
+
+EPOCH = datetime(1970, 1, 1)
+
+def to_seconds(timestamps):
+    '''Converts a list of datetime objects in a numpy array of seconds'''
+    return numpy.array([(t - EPOCH).total_seconds() for t in timestamps],
+                       dtype=numpy.float64)
+
+def from_seconds(seconds):
+    '''Converts an array of seconds back in a list of datetime objects'''
+    return [EPOCH + timedelta(seconds=float(s)) for s in seconds]
+
+def sample_last(grid, seconds, values):
+    '''Samples a series on the grid (both arrays of seconds) by taking the
+    last value seen at or before each grid point. Grid points before the
+    first sample or after the last one are NaN, so that a series is not
+    extended past the time it existed'''
+    idx = numpy.searchsorted(seconds, grid, side='right') - 1
+    ret = numpy.asarray(values, dtype=numpy.float64)[numpy.maximum(idx, 0)]
+    ret[(idx < 0) | (grid > seconds[-1])] = numpy.nan
+    return ret
+
+# Aggregations supported when resampling a series on a coarser grid
+AGGREGATIONS = ['last', 'mean', 'max', 'sum']
+
+def make_grid(series, step=None):
+    '''Returns (grid, step) where grid is an array of seconds covering all
+    the series (a list of arrays of seconds) at the given step. Grid points
+    are multiples of step. If step is None the largest median sampling
+    interval of the series is used, i.e. the resolution of the coarsest
+    series. Returns (None, None) if no grid can be built'''
+    series = [s for s in series if len(s) > 0]
+    if len(series) == 0:
+        return (None, None)
+    if step is None:
+        intervals = [numpy.median(numpy.diff(s)) for s in series if len(s) > 1]
+        intervals = [i for i in intervals if i > 0]
+        if len(intervals) == 0:
+            return (None, None)
+        step = max(intervals)
+    start = min([s[0] for s in series])
+    end = max([s[-1] for s in series])
+    first = numpy.ceil(start / step) * step
+    count = int(numpy.ceil((end - first) / step)) + 1
+    return (first + numpy.arange(count) * step, step)
+
+def resample(grid, step, seconds, values, how='last'):
+    '''Resamples a series on the grid. Every grid point g aggregates the
+    samples within (g - step, g] with one of the AGGREGATIONS:
+    last: the last sample
+    mean: the average of the samples
+    max: the largest sample
+    sum: the samples weighted by their sampling interval divided by step,
+         so that the area under a rate (the total count) is preserved
+    Grid points without any sample are NaN, so gaps stay visible'''
+    if how not in AGGREGATIONS:
+        raise Exception('Unknown aggregation: [%s]' % how)
+    seconds = numpy.asarray(seconds, dtype=numpy.float64)
+    values = numpy.asarray(values, dtype=numpy.float64)
+    ret = numpy.empty(len(grid))
+    ret.fill(numpy.nan)
+    bins = numpy.ceil((seconds - grid[0]) / step).astype(numpy.int64)
+    mask = (bins >= 0) & (bins < len(grid))
+    if not mask.any():
+        return ret
+    if how == 'sum':
+        if len(seconds) > 1:
+            intervals = numpy.diff(seconds)
+            intervals = numpy.concatenate([intervals[:1], intervals])
+        else:
+            intervals = numpy.array([step])
+        values = values * intervals / step
+    (bins, values) = (bins[mask], values[mask])
+    # Samples are in time order, so every bin is a contiguous run
+    starts = numpy.concatenate([[0], numpy.flatnonzero(bins[1:] != bins[:-1]) + 1])
+    used = bins[starts]
+    if how == 'last':
+        ends = numpy.concatenate([starts[1:], [len(bins)]]) - 1
+        ret[used] = values[ends]
+    elif how == 'max':
+        ret[used] = numpy.maximum.reduceat(values, starts)
+    else:
+        totals = numpy.add.reduceat(values, starts)
+        if how == 'mean':
+            totals = totals / numpy.diff(numpy.concatenate([starts, [len(bins)]]))
+        ret[used] = totals
+    return ret
+
+def resample_data(data, step=None, how='last'):
+    '''Resamples a dictionary {metric: {indom: [timestamps, values]}} (the
+    form of PcpStats.all_data) on a single grid. Grid points without samples
+    are dropped. Returns a new dictionary in the same form'''
+    seconds = {}
+    for metric in data:
+        for indom in data[metric]:
+            seconds[(metric, indom)] = to_seconds(data[metric][indom][0])
+    (grid, step) = make_grid(seconds.values(), step)
+    if grid is None:
+        return data
+    timestamps = numpy.array(from_seconds(grid), dtype=object)
+    ret = {}
+    for ((metric, indom), secs) in seconds.items():
+        values = resample(grid, step, secs, data[metric][indom][1], how)
+        mask = numpy.isfinite(values)
+        if mask.any():
+            ret.setdefault(metric, {})[indom] = [list(timestamps[mask]),
+                                                 values[mask].tolist()]
+    return ret
+
+_TOKEN_RE = re.compile(r'\s*(?:(\d+\.?\d*(?:[eE][-+]?\d+)?|\.\d+)|'
+                       r'([A-Za-z_][\w.]*)|(.))')
+
+def _tokenize(text):
+    '''Splits an expression in ('num'|'name'|'op', value) tokens'''
+    tokens = []
+    for (number, name, op) in _TOKEN_RE.findall(text):
+        if number:
+            tokens.append(('num', float(number)))
+        elif name:
+            tokens.append(('name', name))
+        elif op.strip():
+            if op not in '+-*/()':
+                raise Exception('Unexpected character: [%s]' % op)
+            tokens.append(('op', op))
+    return tokens
+
+class _Parser(object):
+    '''Recursive descent parser of arithmetic expressions over metric
+    names. Python's own parser cannot be used as metric names can contain
+    keywords (network.interface.in.bytes). The result is a tree of tuples:
+    ('num', value), ('metric', name), ('neg', node), (op, left, right)'''
+    def __init__(self, text):
+        self.tokens = _tokenize(text)
+        self.pos = 0
+
+    def _peek(self):
+        if self.pos < len(self.tokens):
+            return self.tokens[self.pos]
+        return (None, None)
+
+    def _next(self):
+        token = self._peek()
+        self.pos += 1
+        return token
+
+    def parse(self):
+        node = self._expr()
+        if self.pos != len(self.tokens):
+            raise Exception('Unexpected token: [%s]' % (self._peek()[1],))
+        return node
+
+    def _expr(self):
+        node = self._term()
+        while self._peek() in [('op', '+'), ('op', '-')]:
+            node = (self._next()[1], node, self._term())
+        return node
+
+    def _term(self):
+        node = self._unary()
+        while self._peek() in [('op', '*'), ('op', '/')]:
+            node = (self._next()[1], node, self._unary())
+        return node
+
+    def _unary(self):
+        if self._peek() == ('op', '-'):
+            self._next()
+            return ('neg', self._unary())
+        if self._peek() == ('op', '+'):
+            self._next()
+            return self._unary()
+        return self._atom()
+
+    def _atom(self):
+        (kind, value) = self._next()
+        if kind == 'num':
+            return ('num', value)
+        if kind == 'name':
+            return ('metric', value)
+        if (kind, value) == ('op', '('):
+            node = self._expr()
+            if self._next() != ('op', ')'):
+                raise Exception('Missing closing parenthesis')
+            return node
+        raise Exception('Unexpected token: [%s]' % (value,))
+
+class DerivedMetric(object):
+    '''A metric computed from an arithmetic expression over other metrics,
+    defined as 'name=expression'. For example:
+    net_total=network.interface.in.bytes+network.interface.out.bytes
+
+    Evaluation is done over whole arrays after rate conversion. All the
+    series are aligned on the union of their timestamps and metrics with
+    instances are combined instance by instance and only where all the
+    operands have a sample. A constant or a metric without instances that
+    has a single sample (hinv.ncpu) is broadcast over all the instances
+    and timestamps'''
+    def __init__(self, text):
+        try:
+            (name, expr) = text.split('=', 1)
+        except ValueError:
+            raise Exception('Derived metric must be in the form name=expression')
+        self.name = name.strip()
+        self.expr = expr.strip()
+        if not re.match(r'^[A-Za-z_][\w.]*$', self.name):
+            raise Exception('Invalid derived metric name: [%s]' % self.name)
+        self.tree = _Parser(self.expr).parse()
+        self.metrics = sorted(self._metrics(self.tree))
+
+    def _metrics(self, node):
+        if node[0] == 'metric':
+            return set([node[1]])
+        if node[0] == 'num':
+            return set()
+        return set.union(*[self._metrics(n) for n in node[1:]])
+
+    def evaluate(self, all_data):
+        '''Evaluates the expression over the all_data dictionary of PcpStats.
+        Metrics missing from all_data had only zero values and evaluate to
+        zero. Returns a dictionary {indom: [timestamps, values]} in the same
+        form as all_data, which is empty if no point could be computed'''
+        series = {}
+        for metric in self.metrics:
+            for (indom, (timestamps, values)) in all_data.get(metric, {}).items():
+                series[(metric, indom)] = (to_seconds(timestamps),
+                                           numpy.asarray(values, dtype=numpy.float64))
+        if len(series) == 0:
+            return {}
+        grid = numpy.unique(numpy.concatenate([s[0] for s in series.values()]))
+        aligned = {}
+        for ((metric, indom), (seconds, values)) in series.items():
+            # Metrics without instances are stored under 0
+            if indom == 0 and len(seconds) == 1:
+                aligned.setdefault(metric, {})[indom] = values[0]
+            else:
+                aligned.setdefault(metric, {})[indom] = sample_last(grid, seconds, values)
+
+        with numpy.errstate(divide='ignore', invalid='ignore'):
+            result = self._eval(self.tree, aligned)
+
+        ret = {}
+        if not isinstance(result, dict):
+            result = {0: result}
+        timestamps = numpy.array(from_seconds(grid), dtype=object)
+        for (indom, values) in result.items():
+            values = numpy.zeros(grid.shape) + values
+            mask = numpy.isfinite(values)
+            if mask.any():
+                ret[indom] = [list(timestamps[mask]), values[mask].tolist()]
+        return ret
+
+    def _eval(self, node, aligned):
+        '''Returns either a scalar/array or a dictionary {indom: array}'''
+        kind = node[0]
+        if kind == 'num':
+            return node[1]
+        if kind == 'metric':
+            instances = aligned.get(node[1], {0: 0.0})
+            # Metrics without instances are stored under 0
+            if list(instances.keys()) == [0]:
+                return instances[0]
+            return instances
+        if kind == 'neg':
+            return self._apply(numpy.negative, self._eval(node[1], aligned))
+        func = {'+': numpy.add, '-': numpy.subtract,
+                '*': numpy.multiply, '/': numpy.true_divide}[kind]
+        return self._apply(func, self._eval(node[1], aligned),
+                           self._eval(node[2], aligned))
+
+    def _apply(self, func, *args):
+        '''Applies func, broadcasting values without instances over the
+        instances of the other operand'''
+        dicts = [a for a in args if isinstance(a, dict)]
+        if len(dicts) == 0:
+            return func(*args)
+        indoms = set(dicts[0].keys())
+        for other in dicts[1:]:
+            indoms &= set(other.keys())
+        ret = {}
+        for indom in indoms:
+            ret[indom] = func(*[a[indom] if isinstance(a, dict) else a for a in args])
+        return ret
@@ -19,8 +19,7 @@
 
 from __future__ import print_function
 from hashlib import sha1
-from itertools import repeat
-import multiprocessing
+import glob
 import os
 import re
 import resource
@@ -28,16 +27,9 @@ import shutil
 import sys
 import tempfile
 
-from reportlab.platypus.paragraph import Paragraph
-from reportlab.platypus import PageBreak, Image, Spacer, Table
-from reportlab.lib.pagesizes import A4, landscape
-from reportlab.lib.units import inch
-
-import matplotlib
-import matplotlib.pyplot as plt
-import matplotlib.dates as mdates
-import matplotlib.colors as colors
-import matplotlib.cm as cm
+# NB: reportlab and matplotlib are only imported when a report is actually
+# created. They take most of the startup time and are not needed for
+# metadata-only operations like --list
 #
 # To debug memory leaks
 USE_MELIAE = False
@@ -45,8 +37,8 @@ if USE_MELIAE:
     from meliae import scanner, loader
     import objgraph
 
-from pcp2pdf_style import PcpDocTemplate, tablestyle
 from pcp2pdf_archive import PcpArchive, PcpHelp
+from pcp2pdf_select import MetricSelector
 import cpmapi as c_api
 
 # If we should try and create the graphs in parallel
@@ -54,6 +46,10 @@ import cpmapi as c_api
 THREADED = True
 # None means all available CPUs
 NR_CPUS = None
+# Graphing processes are replaced after drawing this many graphs or once
+# they grow beyond this many MB, as matplotlib never gives memory back
+GRAPH_WORKER_MAXTASKS = 50
+GRAPH_WORKER_MAXRSS = 1024
 
 # Inch graph size (width, height)
 GRAPH_SIZE = (10.5, 6.5)
@@ -64,6 +60,12 @@ X_AXIS = ('Time', 12, '%m-%d %H:%M', 20)
 # of the page
 LEGEND_THRESHOLD = 50
 
+# Metrics with more instances than this are drawn as a heatmap
+HEATMAP_THRESHOLD = 50
+# Maximum number of instance labels on the heatmap Y axis
+HEATMAP_LABELS = 64
+HEATMAP_CMAP = 'YlOrRd'
+
 def ellipsize(text, limit=100):
     '''Truncates a string in a nice-formatted way'''
     ret = text[:limit].rsplit(' ', 1)[0]
@@ -78,12 +80,34 @@ def progress_callback(graph_added):
         sys.stdout.write('-')
     sys.stdout.flush()
 
-def graph_wrapper((pcparch_obj, data)):
-    """This is a wrapper due to pool.map() single argument limit"""
+def graph_wrapper(pcparch_obj, data):
+    """Draws a single graph in a RenderScheduler worker"""
     (label, fname, metrics, text) = data
-    ret = pcparch_obj.create_graph(fname, label, metrics)
-    progress_callback(ret)
-    return ((label, fname, metrics, text), ret)
+    return pcparch_obj.create_graph(fname, label, metrics)
+
+def build_part(parts, idx):
+    """Builds the pdf of one part of the report in a RenderScheduler worker.
+    Returns the TOC entries found in it"""
+    from reportlab.lib.pagesizes import A4, landscape
+    from pcp2pdf_style import PcpDocTemplate
+    (fname, story) = parts[idx]
+    doc = PcpDocTemplate(fname, pagesize=landscape(A4))
+    doc.build(story)
+    return doc.toc_entries
+
+def heading(text, sty):
+    '''Returns a Paragraph with a bookmark, so that it shows up in the
+    table of contents and in the pdf outline'''
+    from reportlab.platypus.paragraph import Paragraph
+    if isinstance(text, list):
+        text = "_".join(text)
+    # create bookmarkname
+    bn = sha1(text + sty.name).hexdigest()
+    # modify paragraph text to include an anchor point with name bn
+    h = Paragraph(text + '<a name="%s"/>' % bn, sty)
+    # store the bookmark name on the flowable so afterFlowable can see this
+    h._bookmarkName = bn
+    return h
 
 def print_mem_usage(data):
     usage = resource.getrusage(resource.RUSAGE_SELF)
@@ -92,62 +116,74 @@ def print_mem_usage(data):
         (usage[2] / 1024.0)))
 
 class PcpStats(object):
-    story = []
-
     def __init__(self, args, start_time=None, end_time=None, inc=None, exc=None,
-                 graphs=None, raw=False):
+                 graphs=None, raw=False, pcphelp=None, threaded=None, derived=None,
+                 interval=None, aggregate='mean', heatmaps=None,
+                 heatmap_threshold=HEATMAP_THRESHOLD, interesting=None, workdir=None,
+                 profiles=None, selector=None):
         self.args = args
-        self.pcphelp = PcpHelp()
+        self.story = []
+        # The help texts can be shared between multiple reports as walking
+        # the local PMNS tree is expensive. When not passed they are only
+        # fetched from pmcd once they are needed
+        self._pcphelp = pcphelp
+        if threaded is None:
+            threaded = THREADED
+        self.threaded = threaded
         self.pcparchive = PcpArchive(args, start=start_time, end=end_time)
         self.raw = raw
-        # Using /var/tmp as /tmp is ram-mounted these days
-        self.tempdir = tempfile.mkdtemp(prefix='pcpstats', dir='/var/tmp')
+        # Resampling step in seconds and aggregation (see pcp2pdf_series)
+        self.interval = interval
+        self.aggregate = aggregate
+        # Regular expressions of the metrics always drawn as heatmaps
+        self.heatmaps = heatmaps or []
+        for i in self.heatmaps:
+            try:
+                re.compile(i)
+            except:
+                print("Failed to parse: {0}".format(i))
+                sys.exit(-1)
+        self.heatmap_threshold = heatmap_threshold
+        # Only graph this many of the highest scoring metrics
+        self.interesting = interesting
+        self.tempdir = None
+        # When set the intermediate results are kept in this directory
+        # and a rerun with the same arguments resumes from them
+        self.workdir = workdir
+        self.checkpoint = None
+        # (label, traceback) of the graphs that could not be drawn
+        self.failed_graphs = []
         # This will contain all the metrics found in the archive file
         self.all_data = {}
-        # Verify which set of metrics are to be used
-        self.metrics = []
-        if not inc and not exc:
-            self.metrics = sorted(self.pcparchive.get_metrics())
-        elif inc and not exc: # Only include filter specified
-            metrics = sorted(self.pcparchive.get_metrics())
-            for i in inc:
-                try:
-                    matched = filter(lambda x: re.match(i, x), metrics)
-                except:
-                    print("Failed to parse: {0}".format(i))
-                    sys.exit(-1)
-                self.metrics.extend(matched)
-        elif not inc and exc: # Only exclude filter specified
-            metrics = sorted(self.pcparchive.get_metrics())
-            matched = []
-            for i in exc:
-                try:
-                    matched.extend(filter(lambda x: re.match(i, x), metrics))
-                except:
-                    print("Failed to parse: {0}".format(i))
-                    sys.exit(-1)
-
-            self.metrics = sorted(list(set(metrics) - set(matched)))
-        else:
-            all_metrics = sorted(self.pcparchive.get_metrics())
-            matched = []
-            for i in exc:
-                try:
-                    matched.extend(filter(lambda x: re.match(i, x), all_metrics))
-                except:
-                    print("Failed to parse: {0}".format(i))
-                    sys.exit(-1)
+        # Verify which set of metrics are to be used. A MetricSelector
+        # passed by the caller (e.g. shared by a batch) takes the place of
+        # inc, exc and profiles
+        if selector is None:
+            try:
+                selector = MetricSelector(inc, exc, profiles)
+            except ValueError, error:
+                print(error)
+                sys.exit(-1)
+        self.metrics = selector.select(self.pcparchive.get_metrics())
 
-            delta_metrics = sorted(list(set(all_metrics) - set(matched)))
-            metrics = sorted(self.pcparchive.get_metrics())
-            for i in inc:
-                try:
-                    matched = filter(lambda x: re.match(i, x), metrics)
-                except:
-                    print("Failed to parse: {0}".format(i))
+        # Verify if there are any derived metrics
+        self.derived = {}
+        if derived:
+            from pcp2pdf_series import DerivedMetric
+        for text in derived or []:
+            try:
+                metric = DerivedMetric(text)
+            except Exception, error:
+                print("Failed to parse: {0}: {1}".format(text, error))
+                sys.exit(-1)
+            if metric.name in self.metrics or metric.name in self.derived:
+                print("Cannot use name {0}. It is an existing metric".format(metric.name))
+                sys.exit(-1)
+            for i in metric.metrics:
+                if i not in self.metrics:
+                    print("Metric '{0}' is not in the available metrics".format(i))
                     sys.exit(-1)
-                delta_metrics.extend(matched)
-            self.metrics = delta_metrics
+            self.derived[metric.name] = metric
 
         self.custom_graphs = []
         # Verify if there are any custom graphs
@@ -162,15 +198,24 @@ class PcpStats(object):
                 sys.exit(-1)
             metrics = metrics_str.split(',')
             for metric in metrics:
-                if metric not in self.metrics:
+                if metric not in self.metrics and metric not in self.derived:
                     print("Metric '{0}' is not in the available metrics".format(metric))
                     sys.exit(-1)
             self.custom_graphs.append((label, metrics))
 
-        matplotlib.rcParams['figure.max_open_warning'] = 100
+    @property
+    def pcphelp(self):
+        '''The PcpHelp object. Created on first use as it needs to walk the
+        PMNS tree of the local pmcd'''
+        if self._pcphelp is None:
+            self._pcphelp = PcpHelp()
+        return self._pcphelp
 
     def _graph_filename(self, metrics, extension='.png'):
-        '''Creates a unique constant file name given a list of metrics'''
+        '''Creates a unique constant file name given a list of metrics.
+        Returns None if no images are rendered (no temporary directory)'''
+        if self.tempdir is None:
+            return None
         if isinstance(metrics, list):
             temp = ''
             for i in metrics:
@@ -181,15 +226,7 @@ class PcpStats(object):
         return fname
 
     def _do_heading(self, text, sty):
-        if isinstance(text, list):
-            text = "_".join(text)
-        # create bookmarkname
-        bn = sha1(text + sty.name).hexdigest()
-        # modify paragraph text to include an anchor point with name bn
-        h = Paragraph(text + '<a name="%s"/>' % bn, sty)
-        # store the bookmark name on the flowable so afterFlowable can see this
-        h._bookmarkName = bn
-        self.story.append(h)
+        self.story.append(heading(text, sty))
 
     def rate_convert(self, timestamps, values):
         '''Given a list of timestamps and a list of values it will return the
@@ -235,7 +272,9 @@ class PcpStats(object):
     def parse(self):
         '''Parses the archive and stores all the metrics in self.all_data. Returns a dictionary
         containing the metrics which have been rate converted'''
-        (all_data, self.skipped_graphs) = self.pcparchive.get_values(progress=progress_callback)
+        # Only the selected metrics are read out of the archive
+        (all_data, self.skipped_graphs) = self.pcparchive.get_values(progress=progress_callback,
+                                                                     metrics=self.metrics)
         print(' total of {0} graphs'.format(len(all_data)), end='')
         if len(self.skipped_graphs) > 0:
             print(' - skipped {0} graphs'.format(len(self.skipped_graphs)), end='')
@@ -253,25 +292,56 @@ class PcpStats(object):
         print(' - total of non-fully zeroed graphs {0}'.format(len(self.all_data)), end='')
 
 
-        if self.raw: # User explicitely asked to not rate convert any metrics
-            return rate_converted
-
-        # Rate convert all the PM_SEM_COUNTER metrics
-        for metric in self.all_data:
-            (mtype, msem, munits) = self.pcparchive.get_metric_info(metric)
-            if msem != c_api.PM_SEM_COUNTER:
-                continue
+        # Unless the user explicitely asked to not rate convert any metrics
+        # rate convert all the PM_SEM_COUNTER metrics
+        if not self.raw:
+            for metric in self.all_data:
+                (mtype, msem, munits) = self.pcparchive.get_metric_info(metric)
+                if msem != c_api.PM_SEM_COUNTER:
+                    continue
 
-            for indom in self.all_data[metric]:
-                data = self.all_data[metric][indom]
-                (ts, val) = self.rate_convert(data[0], data[1])
-                self.all_data[metric][indom] = [ts, val]
-                if rate_converted[metric] == False:
-                    rate_converted[metric] = {}
-                rate_converted[metric][indom] = True
+                for indom in self.all_data[metric]:
+                    data = self.all_data[metric][indom]
+                    (ts, val) = self.rate_convert(data[0], data[1])
+                    self.all_data[metric][indom] = [ts, val]
+                    if rate_converted[metric] == False:
+                        rate_converted[metric] = {}
+                    rate_converted[metric][indom] = True
+
+        # Resample everything on a single grid once, so that all the
+        # following steps work on the reduced data
+        if self.interval:
+            from pcp2pdf_series import resample_data
+            numeric = dict([(m, self.all_data[m]) for m in self.all_data
+                            if not self.is_string_metric(m)])
+            self.all_data.update(resample_data(numeric, self.interval,
+                                               self.aggregate))
+
+        # Derived metrics are computed from the rate converted values
+        for (name, derived) in self.derived.items():
+            values = derived.evaluate(self.all_data)
+            if len(values) > 0:
+                self.all_data[name] = values
+                rate_converted[name] = False
 
         return rate_converted
 
+    def score_metrics(self, metrics):
+        '''Scores how interesting the graph of every metric is (see
+        pcp2pdf_score.interest_score). Returns a dictionary {metric:
+        (score, variability, change, spike, indom)} where the components are
+        the ones of the highest scoring instance of the metric'''
+        from pcp2pdf_score import interest_score
+        scores = {}
+        for metric in metrics:
+            best = (0.0, 0.0, 0.0, 0.0, None)
+            for indom in self.all_data[metric]:
+                score = interest_score(self.all_data[metric][indom][1])
+                if score[0] > best[0] or best[4] is None:
+                    best = score + (indom,)
+            scores[metric] = best
+        return scores
+
     def get_category(self, metrics):
         '''Return the category given one or a list of metric strings'''
         if isinstance(metrics, str):
@@ -299,9 +369,34 @@ class PcpStats(object):
                 break
         return isstring
 
-    def create_graph(self, fname, title, metrics):
-        '''Take a title and a list of metrics and creates an image of
-        the graph'''
+    def align_series(self, metrics):
+        '''Aligns all the instances of the given metrics on a common time
+        grid using self.interval (or the coarsest sampling interval) and
+        self.aggregate. Returns a dictionary in the form of self.all_data
+        where values are NaN at grid points without samples'''
+        from pcp2pdf_series import make_grid, resample, to_seconds, from_seconds
+        seconds = {}
+        for metric in metrics:
+            for indom in self.all_data[metric]:
+                seconds[(metric, indom)] = to_seconds(self.all_data[metric][indom][0])
+        (grid, step) = make_grid(seconds.values(), self.interval)
+        if grid is None:
+            return dict([(m, self.all_data[m]) for m in metrics])
+        timestamps = from_seconds(grid)
+        ret = {}
+        for ((metric, indom), secs) in seconds.items():
+            values = resample(grid, step, secs, self.all_data[metric][indom][1],
+                              self.aggregate)
+            ret.setdefault(metric, {})[indom] = [timestamps, values]
+        return ret
+
+    def _create_figure(self, title):
+        '''Creates a figure with a time series X axis. Returns (fig, axes)'''
+        import matplotlib
+        import matplotlib.pyplot as plt
+        import matplotlib.dates as mdates
+
+        matplotlib.rcParams['figure.max_open_warning'] = 100
         fig = plt.figure(figsize=(GRAPH_SIZE[0], GRAPH_SIZE[1]))
         axes = fig.add_subplot(111)
         # Set X Axis metadata
@@ -310,7 +405,69 @@ class PcpStats(object):
         axes.xaxis.set_major_formatter(mdates.DateFormatter(X_AXIS[2]))
         axes.xaxis.set_minor_locator(mdates.MinuteLocator(interval=X_AXIS[3]))
         fig.autofmt_xdate()
+        return (fig, axes)
+
+    def is_heatmap(self, metrics):
+        '''Returns True if the graph of the metrics is drawn as a heatmap.
+        This is the case for single metrics with more than self.heatmap_threshold
+        instances or matching one of the self.heatmaps regular expressions'''
+        if len(metrics) != 1 or metrics[0] not in self.all_data:
+            return False
+        metric = metrics[0]
+        if len(self.all_data[metric]) < 2:
+            return False
+        if len(self.all_data[metric]) > self.heatmap_threshold:
+            return True
+        return any([re.match(i, metric) for i in self.heatmaps])
+
+    def create_heatmap(self, fname, title, metric):
+        '''Creates an image of the instances x time matrix of a metric. A
+        single raster image replaces one line per instance, which is both
+        faster to draw and readable with hundreds of instances'''
+        import numpy
+        import matplotlib.pyplot as plt
+        import matplotlib.dates as mdates
+
+        values = self.align_series([metric])[metric]
+        indoms = sorted([i for i in values if len(values[i][0]) > 1])
+        if len(indoms) == 0:
+            return False
+        timestamps = values[indoms[0]][0]
+        matrix = numpy.ma.masked_invalid(numpy.array(
+            [numpy.asarray(values[i][1], dtype=numpy.float64) for i in indoms]))
+
+        (fig, axes) = self._create_figure(title)
+        extent = (mdates.date2num(timestamps[0]), mdates.date2num(timestamps[-1]),
+                  len(indoms) - 0.5, -0.5)
+        image = axes.imshow(matrix, aspect='auto', interpolation='nearest',
+                            extent=extent, cmap=plt.get_cmap(HEATMAP_CMAP))
+        axes.xaxis_date()
+        axes.xaxis.set_major_formatter(mdates.DateFormatter(X_AXIS[2]))
+        # Label at most HEATMAP_LABELS instances
+        every = max(1, int(numpy.ceil(len(indoms) / float(HEATMAP_LABELS))))
+        axes.set_yticks(range(0, len(indoms), every))
+        axes.set_yticklabels([str(indoms[i]) for i in range(0, len(indoms), every)],
+                             fontsize='xx-small')
+        axes.set_ylabel('Instances')
+        colorbar = fig.colorbar(image, ax=axes)
+        colorbar.set_label(title)
+
+        plt.savefig(fname, bbox_inches='tight')
+        plt.close('all')
+        return True
 
+    def create_graph(self, fname, title, metrics):
+        '''Take a title and a list of metrics and creates an image of
+        the graph'''
+        import matplotlib
+        import matplotlib.pyplot as plt
+        import matplotlib.colors as colors
+        import matplotlib.cm as cm
+
+        if self.is_heatmap(metrics):
+            return self.create_heatmap(fname, title, metrics[0])
+
+        (fig, axes) = self._create_figure(title)
         # Set Y Axis metadata
         axes.set_ylabel(title)
         y_formatter = matplotlib.ticker.ScalarFormatter(useOffset=False)
@@ -332,9 +489,15 @@ class PcpStats(object):
         scalar_map = cm.ScalarMappable(norm=color_norm,
                                        cmap=plt.get_cmap('Set1'))
 
+        # Metrics logged at different intervals or with gaps can only be
+        # compared once they share the same timestamps
+        all_data = self.all_data
+        if len(metrics) > 1:
+            all_data = self.align_series(metrics)
+
         # Then we walk the metrics and plot
         for metric in metrics:
-            values = self.all_data[metric]
+            values = all_data[metric]
             for indom in sorted(values):
                 (timestamps, dataset) = values[indom]
                 # Currently if there is only one (timestamp,value) like with filesys.blocksize
@@ -353,19 +516,14 @@ class PcpStats(object):
                         lbl = indom
 
                 found = True
-                try:
-                    axes.plot(timestamps, dataset, 'o:', label=lbl,
-                              color=scalar_map.to_rgba(counter))
-                except:
-                    import traceback
-                    print("Metric: {0}".format(metric))
-                    print(traceback.format_exc())
-                    sys.exit(-1)
+                axes.plot(timestamps, dataset, 'o:', label=lbl,
+                          color=scalar_map.to_rgba(counter))
 
                 indoms += 1
                 counter += 1
 
         if not found:
+            plt.close('all')
             return False
         axes.grid(True)
 
@@ -397,21 +555,70 @@ class PcpStats(object):
             print(summary)
         return True
 
-    def output(self, output_file='output.pdf'):
-        sys.stdout.write('Parsing archive: ')
-        sys.stdout.flush()
-        rate_converted = self.parse()
+    def graph_cost(self, metrics):
+        '''Estimates how expensive drawing a graph is as the total number
+        of samples of all its instances'''
+        cost = 0
+        for metric in metrics:
+            for indom in self.all_data.get(metric, {}):
+                cost += len(self.all_data[metric][indom][0])
+        return cost
+
+    def create_graphs(self):
+        '''Draws all the graphs in self.all_graphs. The most expensive ones
+        are started first so that a large graph does not hold up the end of
+        the run. Returns the graphs that contained data, in self.all_graphs
+        order. Graphs that fail are reported and left out'''
+        self.failed_graphs = []
+        done = set()
+        jobs = self.all_graphs
+        if self.checkpoint:
+            # Graphs drawn by a previous run, with whether they had data
+            drawn = self.checkpoint.records('graphs')
+            jobs = [g for g in jobs if g[1] not in drawn or
+                    (drawn[g[1]] and not os.path.exists(g[1]))]
+            done.update([fname for fname in drawn if drawn[fname]])
+        jobs = sorted(jobs, key=lambda g: self.graph_cost(g[2]), reverse=True)
+        if self.checkpoint:
+            self.checkpoint.track([g[1] for g in jobs])
+        if self.threaded:
+            from pcp2pdf_scheduler import RenderScheduler
+            # Load matplotlib before forking so that the workers, including
+            # the ones replacing recycled workers, do not each import it
+            import matplotlib.pyplot
+            scheduler = RenderScheduler(graph_wrapper, self, NR_CPUS,
+                                        GRAPH_WORKER_MAXTASKS, GRAPH_WORKER_MAXRSS)
+            results = scheduler.imap_unordered(jobs)
+        else:
+            results = self._create_graphs_serial(jobs)
+
+        for (graph, ok, ret) in results:
+            if not ok:
+                self.failed_graphs.append((graph[0], ret))
+                ret = False
+            else:
+                if ret:
+                    done.add(graph[1])
+                if self.checkpoint:
+                    self.checkpoint.record('graphs', graph[1], ret)
+            progress_callback(ret)
         print()
-        doc = PcpDocTemplate(output_file, pagesize=landscape(A4))
-        hostname = self.pcparchive.get_hostname()
-        self.story.append(Paragraph('%s' % hostname, doc.centered))
-        self.story.append(Spacer(1, 0.05 * inch))
-        self.story.append(Paragraph('%s' % (" ".join(self.args)),
-                          doc.small_centered))
-        self._do_heading('Table of contents', doc.centered_index)
-        self.story.append(doc.toc)
-        self.story.append(PageBreak())
+        for (label, error) in self.failed_graphs:
+            print("Failed to graph {0}:\n{1}".format(label, error))
+        return [graph for graph in self.all_graphs if graph[1] in done]
 
+    def _create_graphs_serial(self, jobs):
+        for graph in jobs:
+            try:
+                yield (graph, True, graph_wrapper(self, graph))
+            except Exception:
+                import traceback
+                yield (graph, False, traceback.format_exc())
+
+    def prepare_graphs(self, rate_converted):
+        '''Fills self.all_graphs with the graphs to draw. Returns a tuple
+        (string_metrics, scores) with the metrics that have string values
+        and the --interesting scores (None unless self.interesting is set)'''
         # Prepare the full list of graphs that will be drawn
         # Start with any custom graphs if they exist and
         # proceed with the remaining ones. Split the metrics
@@ -438,6 +645,10 @@ class PcpStats(object):
                 string_metrics.append(metric)
             else:
                 fname = self._graph_filename([metric])
+                if metric in self.derived:
+                    text = '<strong>%s</strong>: %s' % (metric, self.derived[metric].expr)
+                    self.all_graphs.append((metric, fname, [metric], text))
+                    continue
                 units = self.pcparchive.get_metric_info(metric)[2]
                 text = '%s' % units
                 if isinstance(metric, str) and metric in self.pcphelp.help_text:
@@ -447,28 +658,23 @@ class PcpStats(object):
                     text = text + ' - <em>%s</em>' % 'rate converted'
                 self.all_graphs.append((metric, fname, [metric], text))
 
-        done_metrics = []
-        # This list contains the metrics that contained data
-        print('Creating graphs: ', end='')
-        if THREADED:
-            pool = multiprocessing.Pool(NR_CPUS)
-            l = zip(repeat(self), self.all_graphs)
-            metrics_rets = pool.map(graph_wrapper, l)
-            (metrics, rets) = zip(*metrics_rets)
-            done_metrics = [metric for (metric, ret) in metrics_rets if ret]
-        else:
-            for graph in self.all_graphs:
-                (label, fname, metrics, text) = graph
-                if self.create_graph(fname, label, metrics):
-                    progress_callback(True)
-                    done_metrics.append(graph)
-                else:
-                    # Graphs had all zero values
-                    progress_callback(False)
-
-        print()
-        # Build the string metrics table. It only prints
-        # a value if it changed over time
+        # Only keep the self.interesting highest scoring metrics. Custom
+        # graphs were explicitely asked for, so they are always kept
+        scores = None
+        if self.interesting is not None:
+            custom = set([graph[0] for graph in self.custom_graphs])
+            single = [g[0] for g in self.all_graphs if g[0] not in custom]
+            scores = self.score_metrics(single)
+            ranked = sorted(single, key=lambda m: scores[m][0], reverse=True)
+            keep = set(ranked[:self.interesting]) | custom
+            self.all_graphs = [g for g in self.all_graphs if g[0] in keep]
+            print('Selected {0} interesting graphs out of {1}'.format(
+                  len(keep & set(single)), len(single)))
+        return (string_metrics, scores)
+
+    def string_metrics_table(self, string_metrics):
+        '''Returns the rows of the string metrics table, header included'''
+        # Only print a value if it changed over time
         data = [('Metric', 'Timestamp', 'Value')]
         for metric in string_metrics:
             last_value = None
@@ -480,7 +686,62 @@ class PcpStats(object):
                         text = ellipsize(v)
                         data.append((metric, '%s' % ts, text))
                         last_value = v
+        return data
 
+    def output(self, output_file='output.pdf'):
+        if output_file.endswith('.html'):
+            from pcp2pdf_html import PcpHtmlReport
+            PcpHtmlReport(self).output(output_file)
+            return
+
+        from reportlab.platypus.paragraph import Paragraph
+        from reportlab.platypus import PageBreak, Image, Spacer, Table
+        from reportlab.lib.pagesizes import A4, landscape
+        from reportlab.lib.units import inch
+        from pcp2pdf_style import PcpDocTemplate, tablestyle
+
+        if self.workdir:
+            from pcp2pdf_checkpoint import Checkpoint
+            try:
+                self.checkpoint = Checkpoint(self.workdir, self.checkpoint_key())
+            except ValueError, error:
+                print("Error: {0}".format(error))
+                sys.exit(-1)
+            self.tempdir = self.workdir
+        else:
+            # Using /var/tmp as /tmp is ram-mounted these days
+            self.tempdir = tempfile.mkdtemp(prefix='pcpstats', dir='/var/tmp')
+        snapshot = None
+        if self.checkpoint:
+            snapshot = self.checkpoint.load('data')
+        if snapshot:
+            print('Resuming from: {0}'.format(self.workdir))
+            (self.all_data, self.skipped_graphs, rate_converted) = snapshot
+        else:
+            sys.stdout.write('Parsing archive: ')
+            sys.stdout.flush()
+            rate_converted = self.parse()
+            print()
+            if self.checkpoint:
+                self.checkpoint.save('data', (self.all_data, self.skipped_graphs,
+                                              rate_converted))
+        doc = PcpDocTemplate(output_file, pagesize=landscape(A4))
+        hostname = self.pcparchive.get_hostname()
+        self.story.append(Paragraph('%s' % hostname, doc.centered))
+        self.story.append(Spacer(1, 0.05 * inch))
+        self.story.append(Paragraph('%s' % (" ".join(self.args)),
+                          doc.small_centered))
+        self._do_heading('Table of contents', doc.centered_index)
+        self.story.append(doc.toc)
+        self.story.append(PageBreak())
+
+        (string_metrics, scores) = self.prepare_graphs(rate_converted)
+
+        # This list contains the metrics that contained data
+        print('Creating graphs: ', end='')
+        done_metrics = self.create_graphs()
+
+        data = self.string_metrics_table(string_metrics)
         if len(data) > 1:
             self._do_heading('String metrics', doc.h1)
             self.story.append(Spacer(1, 0.2 * inch))
@@ -491,30 +752,161 @@ class PcpStats(object):
 
         # At this point all images are created let's build the pdf
         print("Building pdf: ", end='')
-        # Add the graphs to the pdf
+        # Add the graphs to the pdf, one part per category. A part is
+        # a tuple (labels, story) where labels identify its content
+        parts = []
         last_category = ''
         for graph in done_metrics:
             (label, fname, metrics, text) = graph
             category = self.get_category(metrics)
             if last_category != category:
-                self._do_heading(category, doc.h1)
+                (labels, story) = ([category], [heading(category, doc.h1)])
+                parts.append((labels, story))
                 last_category = category
 
-            self._do_heading(label, doc.h2_invisible)
-            self.story.append(Image(fname, width=GRAPH_SIZE[0]*inch,
-                              height=GRAPH_SIZE[1]*inch))
+            labels.append(label)
+            story.append(heading(label, doc.h2_invisible))
+            story.append(Image(fname, width=GRAPH_SIZE[0]*inch,
+                         height=GRAPH_SIZE[1]*inch))
             if text:
-                self.story.append(Paragraph(text, doc.normal))
-            self.story.append(PageBreak())
+                story.append(Paragraph(text, doc.normal))
+            story.append(PageBreak())
             sys.stdout.write('.')
             sys.stdout.flush()
 
-        doc.multiBuild(self.story)
+        if scores is not None:
+            story = [heading('Appendix: interesting metrics scores', doc.h1)]
+            parts.append(([story[0].getPlainText()] + [g[0] for g in done_metrics], story))
+            story.append(Spacer(1, 0.2 * inch))
+            data = [('Metric', 'Instance', 'Variability', 'Change', 'Spike', 'Score')]
+            for (label, fname, metrics, text) in sorted(done_metrics,
+                    key=lambda g: scores.get(g[0], (0,))[0], reverse=True):
+                if label not in scores:
+                    continue
+                (score, variability, change, spike, indom) = scores[label]
+                data.append((label, '' if indom == 0 else indom, '%.2f' % variability,
+                             '%.2f' % change, '%.2f' % spike, '%.2f' % score))
+            table = Table(data)
+            table.setStyle(tablestyle)
+            story.append(table)
+            story.append(PageBreak())
+
+        try:
+            self.build_pdf(doc, output_file, parts)
+        except:
+            # A work directory is kept to resume from
+            if not self.checkpoint:
+                shutil.rmtree(self.tempdir)
+            raise
         print()
         print("Done building: {0}".format(output_file))
-        shutil.rmtree(self.tempdir)
+        if self.checkpoint and len(self.failed_graphs) > 0:
+            # Keep the work directory so that a rerun only retries the
+            # graphs that failed
+            print("Keeping: {0}".format(self.tempdir))
+            return
+        if self.checkpoint:
+            self.checkpoint.remove()
+        else:
+            shutil.rmtree(self.tempdir)
         print("Done removing: {0}".format(self.tempdir))
 
+    def checkpoint_key(self):
+        '''Identifies the archive and the arguments of a report, so that
+        a resumed run only reuses the results of an identical one'''
+        archives = []
+        for fname in sorted(glob.glob(self.args + '*')):
+            archives.append((fname, os.path.getsize(fname), os.path.getmtime(fname)))
+        derived = sorted([(name, d.expr) for (name, d) in self.derived.items()])
+        key = (archives, self.pcparchive.start, self.pcparchive.end, sorted(self.metrics),
+               self.custom_graphs, self.raw, derived, self.interval, self.aggregate,
+               self.heatmaps, self.heatmap_threshold, self.interesting)
+        return sha1(repr(key)).hexdigest()
+
+    def build_pdf(self, doc, output_file, parts):
+        '''Builds the pdf out of self.story, with the title page and the
+        table of contents, followed by the list of stories in parts. When
+        threaded and PyPDF2 is available the parts are built in parallel
+        and merged, otherwise the whole document is built at once'''
+        try:
+            from PyPDF2 import PdfFileMerger, PdfFileReader
+        except ImportError:
+            PdfFileMerger = None
+            if self.threaded and len(parts) > 1:
+                print("PyPDF2 is not installed, building the pdf in a single process")
+        if not self.threaded or PdfFileMerger is None or len(parts) < 2:
+            for (labels, story) in parts:
+                self.story.extend(story)
+            doc.multiBuild(self.story)
+            return
+
+        from reportlab.platypus import PageBreak
+        from pcp2pdf_scheduler import RenderScheduler
+        from pcp2pdf_style import TocEntries
+        # Every part starts on a new page anyway
+        for story in [self.story] + [story for (labels, story) in parts]:
+            if isinstance(story[-1], PageBreak):
+                story.pop()
+        fnames = []
+        for (labels, story) in parts:
+            name = 'part-%s.pdf' % sha1('\n'.join(labels)).hexdigest()
+            fnames.append(os.path.join(self.tempdir, name))
+        if self.checkpoint:
+            self.checkpoint.track(fnames + ['front.pdf'])
+        # Parts built by a previous run have their TOC entries saved
+        part_entries = {}
+        if self.checkpoint:
+            for (idx, fname) in enumerate(fnames):
+                entries = self.checkpoint.load(os.path.basename(fname) + '.toc')
+                if entries is not None and os.path.exists(fname):
+                    part_entries[idx] = entries
+        jobs = [idx for idx in range(len(parts)) if idx not in part_entries]
+        scheduler = RenderScheduler(build_part, zip(fnames, [p[1] for p in parts]), NR_CPUS)
+        failed = False
+        for (idx, ok, ret) in scheduler.imap_unordered(jobs):
+            if not ok:
+                print("Failed to build {0}:\n{1}".format(fnames[idx], ret))
+                failed = True
+                continue
+            part_entries[idx] = ret
+            if self.checkpoint:
+                self.checkpoint.save(os.path.basename(fnames[idx]) + '.toc', ret)
+
+        if failed:
+            # Build the whole document at once instead, which fails with
+            # a normal exception if the part is really broken
+            print("Building the whole pdf at once")
+            for (labels, story) in parts:
+                self.story.append(PageBreak())
+                self.story.extend(story)
+            doc.multiBuild(self.story)
+            return
+
+        # The TOC entries of the parts, numbered from the end of the
+        # first document
+        entries = []
+        offset = 0
+        for (idx, fname) in enumerate(fnames):
+            entries.extend([(level, text, offset + page, key)
+                            for (level, text, page, key) in part_entries[idx]])
+            with open(fname, 'rb') as part:
+                offset += PdfFileReader(part).getNumPages()
+        self.story.append(TocEntries(entries))
+        doc.filename = os.path.join(self.tempdir, 'front.pdf')
+        doc.multiBuild(self.story)
+
+        merger = PdfFileMerger()
+        for fname in [doc.filename] + fnames:
+            merger.append(fname)
+        # The TOC links of the first document point to the headings of
+        # the parts by name
+        first = doc.page
+        for (level, text, page, key) in entries:
+            if key is not None:
+                merger.addNamedDestination(key, first + page - 1)
+        merger.write(output_file)
+        merger.close()
+
     def print_info(self):
         # Print interval
         (start, end) = self.pcparchive.get_timeinterval()
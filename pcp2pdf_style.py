@@ -20,6 +20,8 @@ from reportlab.lib.styles import ParagraphStyle as PS
 from reportlab.platypus.doctemplate import PageTemplate, BaseDocTemplate
 from reportlab.platypus.tableofcontents import TableOfContents
 from reportlab.platypus.frames import Frame
+from reportlab.platypus.flowables import Flowable
+from reportlab.pdfbase.pdfdoc import PDFString, format as pdf_format
 from reportlab.lib.units import inch
 import reportlab.lib.colors
 
@@ -30,6 +32,38 @@ tablestyle = [ ('GRID', (0,0), (-1,-1), 1, reportlab.lib.colors.black),
                ('FONTSIZE', (0,0), (-1,-1), 10),
                ('FONTNAME', (0,0), (-1,0), 'Times-Bold'), ]
 
+class NamedDestination(object):
+    """Destination format that refers to a bookmark by name, so that the
+    pdf viewer resolves it in the named destinations of the document"""
+    page = None
+
+    def __init__(self, name):
+        self.name = name
+
+    def format(self, document):
+        return pdf_format(PDFString(self.name), document)
+
+class TocEntries(Flowable):
+    """Zero sized flowable adding the TOC entries (level, text, page, key)
+    of the documents that will be appended after this one. Their page
+    numbers are relative to the page this flowable is drawn on, so it
+    must be the last one. The links to their bookmark keys point to
+    named destinations, which must be added to the merged document"""
+    def __init__(self, entries):
+        Flowable.__init__(self)
+        self.entries = entries
+
+    def wrap(self, availWidth, availHeight):
+        return (0, 0)
+
+    def draw(self):
+        for (level, text, page, key) in self.entries:
+            if key is None:
+                continue
+            dest = self.canv._bookmarkReference(key)
+            dest.fmt = NamedDestination(key)
+            dest.setPage(self.canv._doc.thisPageRef())
+
 class PcpDocTemplate(BaseDocTemplate):
     """Custom Doc Template in order to have bookmarks
     for certain type of text"""
@@ -95,6 +129,8 @@ class PcpDocTemplate(BaseDocTemplate):
             fontSize=16,
             leading=16)
 
+        # (level, text, page, key) of the TOC entries of the last build pass
+        self.toc_entries = []
         self.toc = TableOfContents()
         self.toc.levelStyles = [
             PS(fontName='Times-Bold', fontSize=14, name='TOCHeading1',
@@ -103,9 +139,15 @@ class PcpDocTemplate(BaseDocTemplate):
                 firstLineIndent=-20, spaceBefore=0, leading=8),
         ]
 
+    def beforeDocument(self):
+        self.toc_entries = []
+
     def afterFlowable(self, flowable):
         """Registers TOC entries."""
-        if flowable.__class__.__name__ == 'Paragraph':
+        if isinstance(flowable, TocEntries):
+            for (level, text, page, key) in flowable.entries:
+                self.notify('TOCEntry', (level, text, self.page + page, key))
+        elif flowable.__class__.__name__ == 'Paragraph':
             text = flowable.getPlainText()
             style = flowable.style.name
             if style in ['Heading1', 'centered_index']:
@@ -117,6 +159,7 @@ class PcpDocTemplate(BaseDocTemplate):
             entry = [level, text, self.page]
             #if we have a bookmark name append that to our notify data
             bookmark_name = getattr(flowable, '_bookmarkName', None)
+            self.toc_entries.append((level, text, self.page, bookmark_name))
             if bookmark_name is not None:
                 entry.append(bookmark_name)
             self.notify('TOCEntry', tuple(entry))
@@ -47,8 +47,12 @@ config = {
     'url': 'http://github.com/mbaldessari/pcpstats',
     'license': 'GPLv2',
     'cmdclass': {'test': DiscoverTest},
-    'py_modules': ['pcp_archive', 'pcp_stats'],
+    'py_modules': ['pcp2pdf_archive', 'pcp2pdf_batch', 'pcp2pdf_checkpoint',
+                   'pcp2pdf_compare', 'pcp2pdf_html', 'pcp2pdf_scheduler', 'pcp2pdf_score',
+                   'pcp2pdf_select', 'pcp2pdf_series', 'pcp2pdf_stats', 'pcp2pdf_style'],
     'scripts': ['pcp2pdf'],
+    # Builds the pdf parts in parallel and merges them
+    'extras_require': {'merge': ['PyPDF2']},
     'classifiers': [
         "Development Status :: 3 - Alpha",
         "Topic :: Utilities",
@@ -3,17 +3,31 @@ Test unit for pcpstats
 """
 from __future__ import print_function
 import cProfile
+import ctypes
+import datetime
 import os
 import os.path
 import pstats
 import resource
+import shutil
 import StringIO
+import subprocess
 import sys
 import tempfile
 import time
 import unittest
 
+from pcp import pmapi
+import cpmapi as c_api
+
 from pcp2pdf_archive import PcpArchive
+from pcp2pdf_batch import PcpBatch, archive_basename, read_manifest
+from pcp2pdf_checkpoint import Checkpoint
+from pcp2pdf_scheduler import RenderScheduler
+from pcp2pdf_select import MetricSelector, literal_prefix
+from pcp2pdf_score import SeriesSummary, interest_score, ks_statistic, mean_shift
+from pcp2pdf_series import DerivedMetric, make_grid, resample
+from pcp2pdf_stats import PcpStats, heading
 
 # To debug memory leaks
 USE_MELIAE = False
@@ -27,6 +41,11 @@ TOP_PROFILED_FUNCTIONS = 15
 
 PCP_FILES = 'pcp-files'
 
+# Sanity bound in seconds on importing pcp2pdf_stats, which only fails
+# if the rendering stack gets loaded again. Metadata-only operations like
+# --list must not load it, which is checked on sys.modules
+IMPORT_TIME_LIMIT = 10
+
 
 class TestPcpStats(unittest.TestCase):
     """Main UnitTest class"""
@@ -90,5 +109,318 @@ class TestPcpStats(unittest.TestCase):
             fname = os.path.basename(test_file)
             self.print_memusage(prefix=fname)
 
+    def test_timeval(self):
+        """Converts datetimes to the archive timevals and back"""
+        archive = PcpArchive.__new__(PcpArchive)
+        dtime = datetime.datetime(2014, 5, 10, 8, 47, 3, 250000)
+        timeval = archive._datetime_to_timeval(dtime)
+        self.assertEqual(timeval.tv_usec, 250000)
+        self.assertEqual(archive._timestamp_to_datetime(timeval), dtime)
+
+    def value_set(self, valfmt, insts, values):
+        """Returns a pmValueSet with one value per instance. values are the
+        in situ lvals or the addresses of the pmValueBlocks"""
+        class ValueSet(ctypes.Structure):
+            _fields_ = [('pmid', ctypes.c_uint), ('numval', ctypes.c_int),
+                        ('valfmt', ctypes.c_int), ('vlist', pmapi.pmValue * len(insts))]
+        vset = ValueSet(0, len(insts), valfmt)
+        for (j, (inst, value)) in enumerate(zip(insts, values)):
+            vset.vlist[j].inst = inst
+            if valfmt == c_api.PM_VAL_INSITU:
+                vset.vlist[j].value.lval = value
+            else:
+                vset.vlist[j].value.pval = ctypes.cast(value, ctypes.POINTER(pmapi.pmValueBlock))
+        # Keep the buffer alive along with the returned pmValueSet
+        self.buffers.append(vset)
+        return pmapi.pmValueSet.from_address(ctypes.addressof(vset))
+
+    def value_blocks(self, ctype, values, stride):
+        """Returns the addresses of pmValueBlocks holding values, placed
+        stride bytes apart in a single buffer"""
+        header = pmapi.pmValueBlock.vbuf.offset
+        buf = ctypes.create_string_buffer(stride * len(values))
+        self.buffers.append(buf)
+        addresses = []
+        for (j, value) in enumerate(values):
+            address = ctypes.addressof(buf) + j * stride
+            if isinstance(value, str):
+                ctypes.memmove(address + header, value, len(value))
+                size = len(value) + 1
+            else:
+                ctype.from_address(address + header).value = value
+                size = ctypes.sizeof(ctype)
+            pmapi.pmValueBlock.from_address(address).vlen = header + size
+            addresses.append(address)
+        return addresses
+
+    def test_extract_values(self):
+        """Reads the values of pmValueSets of every format"""
+        self.buffers = []
+        archive = PcpArchive.__new__(PcpArchive)
+        def extract(vset, mtype):
+            return tuple([a.tolist() for a in archive._extract_values(vset, mtype)])
+        insitu = c_api.PM_VAL_INSITU
+        vset = self.value_set(insitu, [4, 7, 9], [1, -2, 3])
+        self.assertEqual(extract(vset, c_api.PM_TYPE_32),
+                         ([4, 7, 9], [1, -2, 3]))
+        self.assertEqual(extract(vset, c_api.PM_TYPE_U32)[1],
+                         [1, 2**32 - 2, 3])
+        vset = self.value_set(insitu, [5], [-7])
+        self.assertEqual(extract(vset, c_api.PM_TYPE_32), ([5], [-7]))
+
+        dptr = c_api.PM_VAL_DPTR
+        big = [2**40, 2**63 + 5, 7]
+        doubles = [0.5, -1.25, 1e100]
+        # Packed blocks, as in a decoded archive record, and blocks far
+        # apart from each other
+        for stride in [16, 1024]:
+            blocks = self.value_blocks(ctypes.c_uint64, big, stride)
+            vset = self.value_set(dptr, [1, 2, 3], blocks)
+            self.assertEqual(extract(vset, c_api.PM_TYPE_U64),
+                             ([1, 2, 3], big))
+            blocks = self.value_blocks(ctypes.c_double, doubles, stride)
+            vset = self.value_set(dptr, [1, 2, 3], blocks)
+            self.assertEqual(extract(vset, c_api.PM_TYPE_DOUBLE)[1],
+                             doubles)
+        blocks = self.value_blocks(ctypes.c_int64, [-2**40], 16)
+        vset = self.value_set(dptr, [0], blocks)
+        self.assertEqual(extract(vset, c_api.PM_TYPE_64), ([0], [-2**40]))
+
+        blocks = self.value_blocks(None, ['eth0', 'a longer string'], 64)
+        vset = self.value_set(dptr, [1, 2], blocks)
+        self.assertEqual(extract(vset, c_api.PM_TYPE_STRING),
+                         ([1, 2], ['eth0', 'a longer string']))
+        vset = self.value_set(dptr, [1], blocks[1:])
+        self.assertEqual(extract(vset, c_api.PM_TYPE_STRING)[1],
+                         ['a longer string'])
+
+        vset = self.value_set(insitu, [1, 2], [1, 2])
+        self.assertRaises(ValueError, archive._extract_values, vset, c_api.PM_TYPE_64)
+        self.assertRaises(ValueError, archive._extract_values, vset, c_api.PM_TYPE_STRING)
+        self.assertRaises(ValueError, archive._extract_values, vset, 12345)
+
+    def test_import_time(self):
+        """Verifies that importing pcp2pdf_stats does not pull in matplotlib
+        or reportlab"""
+        code = ('import sys, time; start = time.time(); import pcp2pdf_stats; '
+                'print(time.time() - start); '
+                'print(len([m for m in sys.modules '
+                'if m.split(".")[0] in ("matplotlib", "reportlab")]))')
+        topdir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+        out = subprocess.check_output([sys.executable, '-c', code], cwd=topdir)
+        (elapsed, heavy_modules) = out.split()
+        print("import pcp2pdf_stats: {0}s".format(elapsed))
+        self.assertEqual(int(heavy_modules), 0)
+        self.assertLess(float(elapsed), IMPORT_TIME_LIMIT)
+
+    def test_derived_metric(self):
+        """Evaluates derived metrics with instance broadcasting"""
+        start = datetime.datetime(2014, 5, 10, 8, 47)
+        ts = [start + datetime.timedelta(seconds=10 * i) for i in range(4)]
+        data = {'network.interface.in.bytes': {'eth0': [ts, [1, 2, 3, 4]],
+                                               'lo': [ts, [5, 5, 5, 5]]},
+                'network.interface.out.bytes': {'eth0': [ts, [1, 1, 1, 1]]},
+                'kernel.all.cpu.idle': {0: [ts, [1, 2, 3, 4]]},
+                'hinv.ncpu': {0: [ts[:1], [4]]}}
+        derived = DerivedMetric('net_total=network.interface.in.bytes+'
+                                'network.interface.out.bytes')
+        self.assertEqual(derived.evaluate(data), {'eth0': [ts, [2, 3, 4, 5]]})
+        derived = DerivedMetric('pct_busy=1-kernel.all.cpu.idle/hinv.ncpu')
+        self.assertEqual(derived.evaluate(data)[0][1], [0.75, 0.5, 0.25, 0.0])
+        derived = DerivedMetric('scaled=network.interface.in.bytes/-(1+1)')
+        self.assertEqual(derived.evaluate(data)['lo'][1], [-2.5] * 4)
+        self.assertRaises(Exception, DerivedMetric, 'broken=(hinv.ncpu')
+
+    def test_derived_metric_instances(self):
+        """Evaluates derived metrics over instances that come and go"""
+        start = datetime.datetime(2014, 5, 10, 8, 47)
+        ts = [start + datetime.timedelta(seconds=10 * i) for i in range(4)]
+        data = {'proc.psinfo.rss': {'p1': [ts[:2], [1024, 2048]],
+                                    'p2': [ts, [1024] * 4],
+                                    'p3': [ts[2:3], [4096]]},
+                'hinv.ncpu': {0: [ts[:1], [4]]}}
+        result = DerivedMetric('x=proc.psinfo.rss/1024').evaluate(data)
+        self.assertEqual(result, {'p1': [ts[:2], [1.0, 2.0]],
+                                  'p2': [ts, [1.0] * 4],
+                                  'p3': [ts[2:3], [4.0]]})
+        result = DerivedMetric('x=proc.psinfo.rss/hinv.ncpu').evaluate(data)
+        self.assertEqual(result['p2'], [ts, [256.0] * 4])
+        self.assertEqual(result['p3'], [ts[2:3], [1024.0]])
+
+    def test_resample(self):
+        """Resamples series logged at different intervals on one grid"""
+        fine = [1.0, 2.0, 3.0, 4.0, 5.0, 6.0, 7.0]
+        coarse = [0.0, 3.0, 6.0, 9.0]
+        (grid, step) = make_grid([fine, coarse])
+        self.assertEqual(step, 3.0)
+        self.assertEqual(list(grid), coarse)
+        last = resample(grid, step, fine, fine, 'last')
+        self.assertEqual(list(last[1:]), [3.0, 6.0, 7.0])
+        self.assertTrue(last[0] != last[0]) # NaN for the empty bin
+        self.assertEqual(list(resample(grid, step, fine, fine, 'mean')[1:]),
+                         [2.0, 5.0, 7.0])
+        self.assertEqual(list(resample(grid, step, fine, fine, 'max')[1:]),
+                         [3.0, 6.0, 7.0])
+        # A constant rate keeps its value on fully covered bins
+        total = resample(grid, step, fine, [2.0] * len(fine), 'sum')
+        self.assertEqual(list(total[1:3]), [2.0, 2.0])
+        self.assertEqual(list(resample(grid, step, coarse, [1, 2, 3, 4])),
+                         [1.0, 2.0, 3.0, 4.0])
+
+    def test_compare_scores(self):
+        """Ranks distribution changes from series summaries"""
+        baseline = SeriesSummary(range(100))
+        self.assertEqual(baseline.count, 100)
+        self.assertAlmostEqual(baseline.p95, 94.05)
+        self.assertEqual(ks_statistic(baseline, SeriesSummary(range(100))), 0.0)
+        shifted = SeriesSummary(range(50, 150))
+        disjoint = SeriesSummary(range(1000, 1100))
+        self.assertTrue(0 < ks_statistic(baseline, shifted) < 1)
+        self.assertEqual(ks_statistic(baseline, disjoint), 1.0)
+        self.assertEqual(ks_statistic(SeriesSummary([1] * 10),
+                                      SeriesSummary([2] * 10)), 1.0)
+        self.assertAlmostEqual(mean_shift(SeriesSummary([1, 1]),
+                                          SeriesSummary([2, 2])), 0.5)
+
+    def test_interest_score(self):
+        """Scores flat, shifting and spiking series"""
+        self.assertEqual(interest_score([5] * 100), (0.0, 0.0, 0.0, 0.0))
+        (score, variability, change, spike) = interest_score([1] * 50 + [10] * 50)
+        self.assertEqual(change, 1.0)
+        self.assertAlmostEqual(score, variability + change + spike)
+        spiky = [100 + (i % 3) for i in range(200)]
+        spiky[100] = 10000
+        self.assertEqual(interest_score(spiky)[3], 1.0)
+        self.assertTrue(interest_score(spiky)[0] > interest_score(spiky[:100])[0])
+
+    def test_render_scheduler(self):
+        """Failing jobs and dying or recycled workers do not stop the others"""
+        def render(obj, job):
+            if job == 3:
+                raise ValueError(job)
+            if job == 5:
+                os._exit(3)
+            return obj * job
+        scheduler = RenderScheduler(render, 10, workers=2, max_tasks=2)
+        results = dict([(job, (ok, ret)) for (job, ok, ret) in
+                        scheduler.imap_unordered(range(9))])
+        self.assertEqual(sorted(results), range(9))
+        self.assertEqual([job for job in results if not results[job][0]], [3, 5])
+        self.assertEqual(results[8], (True, 80))
+
+    def test_batch_outputs(self):
+        """Rejects batch entries writing the same output file"""
+        base = os.path.join(self.pcp_dir, 'server1.internal', '20140510.08.47')
+        self.assertEqual(archive_basename(base + '.0'), '20140510.08.47')
+        self.assertEqual(archive_basename(base + '.meta'), '20140510.08.47')
+        self.assertEqual(archive_basename(base), '20140510.08.47')
+        outdir = tempfile.mkdtemp(prefix='pcpstats')
+        batch = PcpBatch([(base + '.0', 'x.pdf'), (base, './x.pdf')], outdir=outdir)
+        (entries, results) = batch.resolve_outputs()
+        self.assertEqual(entries, [(base + '.0', 'x.pdf')])
+        self.assertEqual([(archive, output) for (archive, output, error) in results],
+                         [(base, './x.pdf')])
+        manifest = os.path.join(outdir, 'manifest')
+        with open(manifest, 'w') as lines:
+            lines.write('{0}.0 x.pdf\n{0} ./x.pdf\n'.format(base))
+        self.assertRaises(Exception, read_manifest, manifest)
+        shutil.rmtree(outdir)
+
+    def test_build_pdf(self):
+        """Merges the pdf parts built in parallel, keeping the TOC links"""
+        try:
+            from PyPDF2 import PdfFileReader
+        except ImportError:
+            self.skipTest('PyPDF2 is not installed')
+        from reportlab.lib.pagesizes import A4, landscape
+        from reportlab.platypus import PageBreak
+        from reportlab.platypus.paragraph import Paragraph
+        from pcp2pdf_style import PcpDocTemplate
+        tempdir = tempfile.mkdtemp(prefix='pcpstats')
+        output = os.path.join(tempdir, 'report.pdf')
+        stats = PcpStats.__new__(PcpStats)
+        (stats.threaded, stats.checkpoint, stats.tempdir) = (True, None, tempdir)
+        doc = PcpDocTemplate(output, pagesize=landscape(A4))
+        stats.story = [Paragraph('host', doc.centered), doc.toc, PageBreak()]
+        headings = [heading(text, doc.h1) for text in ['a', 'a.x', 'b', 'b.y']]
+        parts = [(['a'], [headings[0], PageBreak(), headings[1], PageBreak()]),
+                 (['b'], [headings[2], PageBreak(), Paragraph('text', doc.normal),
+                          PageBreak(), headings[3], PageBreak()])]
+        stats.build_pdf(doc, output, parts)
+        front = doc.page
+        reader = PdfFileReader(open(output, 'rb'))
+        self.assertEqual(reader.getNumPages(), front + 5)
+        dests = reader.getNamedDestinations()
+        pages = [reader.getDestinationPageNumber(dests[h._bookmarkName]) for h in headings]
+        self.assertEqual(pages, [front, front + 1, front + 2, front + 4])
+        links = []
+        for page in [reader.getPage(i) for i in range(front)]:
+            for annot in page.get('/Annots', []):
+                links.append(annot.getObject()['/Dest'])
+        self.assertEqual(set(links), set([h._bookmarkName for h in headings]))
+        shutil.rmtree(tempdir)
+
+    def test_checkpoint(self):
+        """Results survive a rerun with the same key only"""
+        workdir = os.path.join(tempfile.mkdtemp(prefix='pcpstats'), 'work')
+        checkpoint = Checkpoint(workdir, 'key')
+        self.assertFalse(checkpoint.resumed)
+        checkpoint.save('data', {'a': [1, 2]})
+        checkpoint.record('graphs', 'a.png', True)
+        with open(checkpoint.path('graphs.log'), 'a') as log:
+            log.write('["b.png", tr')
+        checkpoint = Checkpoint(workdir, 'key')
+        self.assertTrue(checkpoint.resumed)
+        self.assertEqual(checkpoint.load('data'), {'a': [1, 2]})
+        self.assertEqual(checkpoint.records('graphs'), {'a.png': True})
+        checkpoint = Checkpoint(workdir, 'other')
+        self.assertFalse(checkpoint.resumed)
+        self.assertEqual(checkpoint.load('data'), None)
+        checkpoint.remove()
+        # Directories not created by a Checkpoint are never removed, only
+        # the files written into them are
+        os.mkdir(workdir)
+        checkpoint = Checkpoint(workdir, 'key')
+        checkpoint.save('data', [1])
+        checkpoint.track([checkpoint.path('a.png')])
+        open(checkpoint.path('a.png'), 'w').close()
+        checkpoint = Checkpoint(workdir, 'key')
+        self.assertTrue(checkpoint.resumed)
+        checkpoint.record('graphs', 'a.png', True)
+        checkpoint = Checkpoint(workdir, 'other')
+        self.assertFalse(checkpoint.resumed)
+        self.assertEqual(checkpoint.load('data'), None)
+        self.assertFalse(os.path.exists(checkpoint.path('a.png')))
+        checkpoint.save('data', [2])
+        checkpoint.remove()
+        self.assertEqual(os.listdir(workdir), [])
+        open(os.path.join(workdir, 'mine'), 'w').close()
+        self.assertRaises(ValueError, Checkpoint, workdir, 'key')
+        self.assertTrue(os.path.exists(os.path.join(workdir, 'mine')))
+
+    def test_metric_selector(self):
+        """Resolves subtree, glob and regex selectors"""
+        names = ['kernel.all.cpu.user', 'kernel.all.cpu.sys', 'kernel.percpu.cpu.user',
+                 'network.interface.in.bytes', 'networkfoo.bar', 'mem.util.free']
+        self.assertEqual(MetricSelector().select(names), sorted(names))
+        self.assertEqual(MetricSelector(['tree:kernel.all']).select(names),
+                         ['kernel.all.cpu.sys', 'kernel.all.cpu.user'])
+        self.assertEqual(MetricSelector(['glob:kernel.*.cpu.user']).select(names),
+                         ['kernel.all.cpu.user', 'kernel.percpu.cpu.user'])
+        self.assertEqual(MetricSelector(['glob:**.user']).select(names),
+                         ['kernel.all.cpu.user', 'kernel.percpu.cpu.user'])
+        self.assertEqual(MetricSelector(['network']).select(names),
+                         ['network.interface.in.bytes', 'networkfoo.bar'])
+        self.assertEqual(MetricSelector(['.*user']).select(names),
+                         ['kernel.all.cpu.user', 'kernel.percpu.cpu.user'])
+        self.assertEqual(MetricSelector(['tree:mem'], ['kernel']).select(names),
+                         ['mem.util.free', 'network.interface.in.bytes', 'networkfoo.bar'])
+        self.assertEqual(MetricSelector(None, ['kernel', 'net']).select(names),
+                         ['mem.util.free'])
+        self.assertEqual(MetricSelector(profiles=['memory']).select(names), ['mem.util.free'])
+        self.assertEqual(literal_prefix(r'kernel\.all\.cpus?'), 'kernel.all.cpu')
+        self.assertRaises(ValueError, MetricSelector, ['re:('])
+        self.assertRaises(ValueError, MetricSelector, None, None, ['nonexistent'])
+
 if __name__ == '__main__':
     unittest.main()